@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+#
+# Benchmark analyzer's main stages
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib import analysis, cache, config, cue, tracks_db, tags, version
+import fixtures
+
+LMS_ROOT = '/lms/Music/'
+
+
+def get_config(ctx, db_name, extra={}):
+    cfg = {'extractor':ctx['extractor'], 'essentia':ctx['root'], 'lms':LMS_ROOT, 'db':os.path.join(ctx['tmp'], db_name), 'tmp':ctx['tmp']}
+    cfg.update(extra)
+    path = os.path.join(ctx['tmp'], 'config-%s.json' % db_name)
+    with open(path, 'w') as f:
+        json.dump(cfg, f)
+    return config.read_config(path)
+
+
+def get_track(i):
+    track = {'path':'Artist %d/Album %d/Track %d.mp3' % (i//50, i//10, i), 'tags':{'title':'Track %d' % i, 'artist':'Artist %d' % (i//50), 'album':'Album %d' % (i//10), 'albumartist':None, 'genres':['Rock'], 'duration':180}}
+    for name, model, cls in cache.HIGHLEVEL_VALUES:
+        track[name] = (i%100)/100.0
+    track['bpm'] = 60+(i%120)
+    return track
+
+
+def fill_db(cfg, num_tracks):
+    db = tracks_db.TracksDb(cfg)
+    for i in range(num_tracks):
+        db.add(get_track(i))
+    db.close()
+
+
+def bench_discovery(ctx):
+    cfg = get_config(ctx, 'discovery.db', {'lmsdb':ctx['lmsdb']})
+    lms_meta = cue.LmsCueMetadata(cfg['lmsdb'])
+    db = tracks_db.TracksDb(cfg)
+    start = time.perf_counter()
+    analysed = tracks_db.AnalysedFiles(db, cfg['lookup_per_folder'], cfg['check_inode'])
+    files = list(analysis.get_files_to_analyse(analysed, lms_meta, cfg['lms'], cfg['essentia'], len(cfg['essentia']), ctx['tmp']+'/', len(ctx['tmp'])+1, False))
+    duration = time.perf_counter()-start
+    db.close()
+    return len(files), duration
+
+
+def bench_read_tags(ctx):
+    start = time.perf_counter()
+    for path in ctx['audio_files']:
+        tags.read_tags(path, tracks_db.GENRE_SEPARATOR)
+    return len(ctx['audio_files']), time.perf_counter()-start
+
+
+def bench_read_json(ctx):
+    meta = {'title':'Track', 'artist':'Artist', 'album':'Album', 'albumartist':None, 'genres':None, 'duration':180}
+    start = time.perf_counter()
+    for path in ctx['json_files']:
+        with open(path, 'r') as js:
+            analysis.read_json_file(js, path, path, meta)
+    return len(ctx['json_files']), time.perf_counter()-start
+
+
+def bench_db_add(ctx):
+    cfg = get_config(ctx, 'add.db')
+    tracks = [get_track(i) for i in range(ctx['size'])]
+    start = time.perf_counter()
+    db = tracks_db.TracksDb(cfg)
+    for track in tracks:
+        db.add(track)
+    db.close()
+    return len(tracks), time.perf_counter()-start
+
+
+def bench_db_update(ctx):
+    cfg = get_config(ctx, 'update.db')
+    fill_db(cfg, ctx['size'])
+    tracks = [get_track(i) for i in range(ctx['size'])]
+    start = time.perf_counter()
+    db = tracks_db.TracksDb(cfg)
+    for track in tracks:
+        db.update(track)
+    db.close()
+    return len(tracks), time.perf_counter()-start
+
+
+def bench_db_remove_old(ctx):
+    # Half of the tracks no longer exist
+    cfg = get_config(ctx, 'remove.db')
+    fill_db(cfg, ctx['size'])
+    existing = set(get_track(i)['path'] for i in range(0, ctx['size'], 2))
+    db = tracks_db.TracksDb(cfg)
+    start = time.perf_counter()
+    removed = db.remove_old_tracks(existing)
+    duration = time.perf_counter()-start
+    db.close()
+    # remove_old_tracks() logs, rather than raises, errors - so check result,
+    # otherwise a failure would be reported as a speed-up
+    if removed!=ctx['size']//2:
+        raise RuntimeError('Removed %d tracks, expected %d' % (removed, ctx['size']//2))
+    return ctx['size'], duration
+
+
+def bench_cue(ctx):
+    # Reading CUE metadata from LMS DB, and then looking up each CUE file
+    start = time.perf_counter()
+    lms_meta = cue.LmsCueMetadata(ctx['lmsdb'])
+    count = 0
+    for path in ctx['cue_files']:
+        count += len(cue.get_cue_tracks(lms_meta, LMS_ROOT, path, len(ctx['root']), ctx['tmp']+'/'))
+    return count, time.perf_counter()-start
+
+
+def bench_analyse(ctx):
+    # Complete run, using stub extractor (and no CUE files)
+    cfg = get_config(ctx, 'analyse.db')
+    start = time.perf_counter()
+    analysis.analyse_files(cfg, False, False)
+    return ctx['size'], time.perf_counter()-start
+
+
+BENCHMARKS = {'discovery':bench_discovery, 'read_tags':bench_read_tags, 'read_json':bench_read_json, 'db_add':bench_db_add,
+              'db_update':bench_db_update, 'db_remove_old':bench_db_remove_old, 'cue':bench_cue, 'analyse':bench_analyse}
+
+
+def run_benchmark(name, ctx):
+    # Runs in its own process, so that peak RSS is just that of this benchmark
+    items, duration = BENCHMARKS[name](ctx)
+    return {'benchmark':name, 'size':ctx['size'], 'items':items, 'seconds':duration, 'items_per_sec':items/duration if duration>0 else None,
+            'peak_rss_kib':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def create_library(tmp, size):
+    # size music files (and extractor outputs), plus size/10 CUE albums
+    root = os.path.join(tmp, 'music')+'/'
+    audio_files = fixtures.make_library(root, size)
+    cue_files = fixtures.make_cue_library(root, max(1, size//10))
+    lmsdb = os.path.join(tmp, 'library.db')
+    fixtures.make_lms_db(lmsdb, LMS_ROOT, root, cue_files)
+    json_files = []
+    os.makedirs(os.path.join(tmp, 'json'))
+    for i in range(size):
+        json_files.append(os.path.join(tmp, 'json', '%d.json' % i))
+        fixtures.make_extractor_json(json_files[-1], i)
+    extractor = os.path.join(tmp, 'stub-extractor')
+    fixtures.make_stub_extractor(extractor, json_files[0])
+    return {'root':root, 'tmp':tmp, 'size':size, 'audio_files':audio_files, 'cue_files':cue_files, 'lmsdb':lmsdb, 'json_files':json_files, 'extractor':extractor}
+
+
+def compare(results, path):
+    with open(path, 'r') as f:
+        previous = {(r['benchmark'], r['size']):r for r in json.load(f)['results']}
+    print('\n%-14s %8s %14s %14s' % ('Benchmark', 'Size', 'Items/s', 'Change'))
+    for r in results:
+        prev = previous.get((r['benchmark'], r['size']))
+        if prev is not None and prev['items_per_sec'] and r['items_per_sec']:
+            print('%-14s %8d %14.1f %13.1f%%' % (r['benchmark'], r['size'], r['items_per_sec'], (r['items_per_sec']/prev['items_per_sec']-1.0)*100.0))
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Benchmark analyzer')
+    parser.add_argument('-s', '--sizes', type=str, help='Comma separated list of library sizes (default: %(default)s)', default='100,1000,10000')
+    parser.add_argument('-b', '--benchmarks', type=str, help='Comma separated list of benchmarks to run (default: all). Available: %s' % ', '.join(BENCHMARKS), default=None)
+    parser.add_argument('-o', '--output', type=str, help='Write results, as JSON, to this file', default=None)
+    parser.add_argument('-c', '--compare', type=str, help='Compare results with those of previous run', default=None)
+    args = parser.parse_args()
+    names = list(BENCHMARKS) if args.benchmarks is None else args.benchmarks.split(',')
+    for name in names:
+        if not name in BENCHMARKS:
+            print('Unknown benchmark: %s' % name)
+            exit(-1)
+
+    results = []
+    print('%-14s %8s %8s %10s %14s %12s' % ('Benchmark', 'Size', 'Items', 'Seconds', 'Items/s', 'Peak RSS KiB'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        with tempfile.TemporaryDirectory() as tmp:
+            ctx = create_library(tmp, size)
+            for name in names:
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    r = executor.submit(run_benchmark, name, ctx).result()
+                results.append(r)
+                print('%-14s %8d %8d %10.3f %14.1f %12d' % (r['benchmark'], r['size'], r['items'], r['seconds'], r['items_per_sec'] or 0, r['peak_rss_kib']))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'version':version.ESSENTIA_ANALYZER_VERSION, 'python':platform.python_version(), 'time':int(time.time()), 'results':results}, f, indent=1)
+    if args.compare is not None:
+        compare(results, args.compare)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+#
+# Benchmark tag reading
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib import analysis, tags, tracks_db
+import fixtures
+
+
+def probe_tags(path):
+    # Previous approach - try each parser in turn, opening the file each time
+    parsers = tags.get_parsers()
+    for name in tags.FALLBACK_ORDER:
+        try:
+            return tags.TAG_READERS[name](parsers[name](path), tracks_db.GENRE_SEPARATOR)
+        except:
+            pass
+    return None
+
+
+def benchmark(paths, func, repeat):
+    start = time.perf_counter()
+    for r in range(repeat):
+        for path in paths:
+            func(path, tracks_db.GENRE_SEPARATOR) if func is tags.read_tags else func(path)
+    return (len(paths)*repeat)/(time.perf_counter()-start)
+
+
+def get_files(path):
+    files = {}
+    for root, dirs, entries in os.walk(path):
+        for e in entries:
+            parts = e.rsplit('.', 1)
+            if len(parts)>1 and parts[1].lower() in analysis.AUDIO_EXTENSIONS:
+                files.setdefault(parts[1].lower(), []).append(os.path.join(root, e))
+    return files
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Benchmark tag reading')
+    parser.add_argument('-p', '--path', type=str, help='Folder of music files to use (default: create synthetic files)', default=None)
+    parser.add_argument('-n', '--num-files', type=int, help='Number of synthetic files per format (default: %(default)s)', default=200)
+    parser.add_argument('-r', '--repeat', type=int, help='Number of times to read each file (default: %(default)s)', default=3)
+    args = parser.parse_args()
+
+    tags.get_parsers() # Don't time imports
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.path is None:
+            for fmt in fixtures.MAKERS:
+                fixtures.make_library(os.path.join(tmp, fmt), args.num_files, [fmt])
+            files = get_files(tmp)
+        else:
+            files = get_files(args.path)
+
+        print('%-6s %8s %14s %14s' % ('Format', 'Files', 'read_tags/s', 'probe/s'))
+        for fmt in sorted(files):
+            print('%-6s %8d %14.1f %14.1f' % (fmt, len(files[fmt]), benchmark(files[fmt], tags.read_tags, args.repeat), benchmark(files[fmt], probe_tags, args.repeat)))
@@ -0,0 +1,145 @@
+#
+# Analyse files with Essentia
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+# Synthetic files for benchmarks. Audio files contain valid headers and tags,
+# but silent (MP3) or no (FLAC) audio - enough for tag reading.
+
+import os
+import struct
+
+MP3_FRAME = b'\xff\xfb\x90\x64' + bytes(413) # MPEG1 layer 3, 128kbps, 44.1kHz
+SAMPLE_RATE = 44100
+
+
+def make_mp3(path, title, artist, album, genre, duration=5):
+    from mutagen.id3 import ID3, TALB, TCON, TIT2, TPE1, TPE2
+    with open(path, 'wb') as f:
+        # ~38 frames per second
+        f.write(MP3_FRAME*int(duration*38.28))
+    tags = ID3()
+    tags.add(TIT2(encoding=3, text=title))
+    tags.add(TPE1(encoding=3, text=artist))
+    tags.add(TPE2(encoding=3, text=artist))
+    tags.add(TALB(encoding=3, text=album))
+    tags.add(TCON(encoding=3, text=genre))
+    tags.save(path)
+
+
+def make_flac(path, title, artist, album, genre, duration=5):
+    from mutagen.flac import FLAC
+    # STREAMINFO: block sizes, frame sizes, then 20 bits rate, 3 bits channels-1,
+    # 5 bits bits-per-sample-1, 36 bits total samples - then MD5
+    samples = duration*SAMPLE_RATE
+    info = struct.pack('>HH', 4096, 4096) + bytes(6)
+    info += struct.pack('>Q', (SAMPLE_RATE<<44) | (1<<41) | (15<<36) | samples)
+    info += bytes(16)
+    with open(path, 'wb') as f:
+        f.write(b'fLaC' + bytes([0x80]) + struct.pack('>I', len(info))[1:] + info)
+    audio = FLAC(path)
+    audio['TITLE'] = title
+    audio['ARTIST'] = artist
+    audio['ALBUMARTIST'] = artist
+    audio['ALBUM'] = album
+    audio['GENRE'] = genre
+    audio.save()
+
+
+MAKERS = {'mp3':make_mp3, 'flac':make_flac}
+
+
+def make_library(root, num_tracks, formats=['mp3', 'flac'], tracks_per_album=10, albums_per_artist=5):
+    # Create num_tracks files, as Artist/Album/Track. Returns list of paths.
+    paths = []
+    for i in range(num_tracks):
+        album = i//tracks_per_album
+        artist = album//albums_per_artist
+        fmt = formats[i%len(formats)]
+        folder = os.path.join(root, 'Artist %d' % artist, 'Album %d' % album)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, '%02d Track %d.%s' % (i%tracks_per_album+1, i, fmt))
+        MAKERS[fmt](path, 'Track %d' % i, 'Artist %d' % artist, 'Album %d' % album, 'Rock', 5+(i%7)*30)
+        paths.append(path)
+    return paths
+
+
+def make_cue_library(root, num_albums, tracks_per_album=10):
+    # CUE albums, as (source file, CUE file) pairs - contents are not valid, as
+    # only the LMS DB is read for CUE tracks. Returns list of source files.
+    paths = []
+    for i in range(num_albums):
+        folder = os.path.join(root, 'CUE Artist %d' % (i//5), 'CUE Album %d' % i)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, 'Album.flac')
+        with open(path, 'wb') as f:
+            f.write(b'fLaC' + bytes(tracks_per_album))
+        with open(os.path.join(folder, 'Album.cue'), 'w') as f:
+            f.write('FILE "Album.flac" WAVE\n')
+        paths.append(path)
+    return paths
+
+
+def make_lms_db(path, lms_root, root, cue_files, tracks_per_album=10):
+    # LMS library.db, with just the tables (and columns) read for CUE tracks.
+    # Paths are converted from root to lms_root, as LMS may be on another machine.
+    import sqlite3
+    from urllib.parse import quote
+    conn = sqlite3.connect(path)
+    conn.executescript('''CREATE TABLE tracks (id integer PRIMARY KEY, url text, title text, album integer, secs real);
+                          CREATE TABLE albums (id integer PRIMARY KEY, title text);
+                          CREATE TABLE genres (id integer PRIMARY KEY, name text);
+                          CREATE TABLE genre_track (track integer, genre integer);
+                          CREATE TABLE contributors (id integer PRIMARY KEY, name text);
+                          CREATE TABLE contributor_track (track integer, contributor integer, role integer);
+                          INSERT INTO genres VALUES (1, 'Rock'), (2, 'Pop');''')
+    track_id = 1
+    for album, src in enumerate(cue_files):
+        url = 'file://' + quote(lms_root + src[len(root):])
+        conn.execute('INSERT INTO albums VALUES (?, ?)', (album+1, 'CUE Album %d' % album))
+        conn.execute('INSERT INTO contributors VALUES (?, ?)', (album+1, 'CUE Artist %d' % (album//5)))
+        for t in range(tracks_per_album):
+            conn.execute('INSERT INTO tracks VALUES (?, ?, ?, ?, ?)', (track_id, '%s#%d-%d' % (url, t*180, (t+1)*180), 'Track %d' % t, album+1, 180))
+            conn.execute('INSERT INTO genre_track VALUES (?, ?)', (track_id, 1+(t%2)))
+            conn.execute('INSERT INTO contributor_track VALUES (?, ?, 1)', (track_id, album+1))
+            conn.execute('INSERT INTO contributor_track VALUES (?, ?, 5)', (track_id, album+1))
+            track_id += 1
+    conn.commit()
+    conn.close()
+
+
+def get_extractor_output(seed):
+    # Values used by the analyzer, plus lowlevel frame data so that the JSON is
+    # of a similar size (~100KiB) to the real extractor's output
+    import random
+    rand = random.Random(seed)
+    models = [('danceability', 'danceable'), ('mood_aggressive', 'aggressive'), ('mood_electronic', 'electronic'),
+              ('mood_acoustic', 'acoustic'), ('mood_happy', 'happy'), ('mood_party', 'party'), ('mood_relaxed', 'relaxed'),
+              ('mood_sad', 'sad'), ('timbre', 'dark'), ('tonal_atonal', 'tonal'), ('voice_instrumental', 'voice')]
+    highlevel = {}
+    for model, cls in models:
+        value = rand.random()
+        highlevel[model] = {'all':{cls:value, 'not_'+cls:1.0-value}, 'probability':max(value, 1.0-value), 'value':cls if value>=0.5 else 'not_'+cls}
+    lowlevel = {'mfcc':{'mean':[rand.random() for i in range(13)], 'cov':[[rand.random() for i in range(13)] for j in range(13)]},
+                'spectral_energyband_low':{'frames':[rand.random() for i in range(4000)]}}
+    return {'highlevel':highlevel, 'rhythm':{'bpm':60+rand.random()*120}, 'lowlevel':lowlevel}
+
+
+def make_extractor_json(path, seed):
+    import json
+    with open(path, 'w') as f:
+        json.dump(get_extractor_output(seed), f)
+
+
+STUB_EXTRACTOR = '''#!/bin/sh
+# Stub extractor - copies pre-generated output, after optional delay
+%scp '%s' "$2"
+'''
+
+def make_stub_extractor(path, output, delay=0.0):
+    # output is the JSON file to copy
+    with open(path, 'w') as f:
+        f.write(STUB_EXTRACTOR % ('sleep %f\n' % delay if delay>0 else '', output))
+    os.chmod(path, 0o755)
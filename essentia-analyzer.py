@@ -10,7 +10,7 @@
 import argparse
 import logging
 import os
-from lib import analysis, config, tags, version
+from lib import analysis, cluster, config, tags, version, watch
 
 _LOGGER = logging.getLogger(__name__)
         
@@ -20,8 +20,25 @@ if __name__=='__main__':
     parser.add_argument('-l', '--log-level', action='store', choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'], default='INFO', help='Set log level (default: %(default)s)')
     parser.add_argument('-m', '--meta-only', action='store_true', default=False, help='Update metadata database only')
     parser.add_argument('-k', '--keep-old', action='store_true', default=False, help='Do not remove non-existant tracks from DB')
+    parser.add_argument('-w', '--watch', action='store_true', default=False, help='Keep running, and update DB as music files change')
+    parser.add_argument('-C', '--coordinator', action='store_true', default=False, help='Find tracks to analyse, and wait for workers to analyse them')
+    parser.add_argument('-W', '--worker', type=str, help='Analyse tracks for coordinator at this URL (e.g. http://host:11001)', default=None)
+    parser.add_argument('-r', '--rebuild', action='store_true', default=False, help='Add tracks to DB using cached results only (requires json_cache)')
     args = parser.parse_args()
     logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=args.log_level, datefmt='%Y-%m-%d %H:%M:%S')
     cfg = config.read_config(args.config)
-    analysis.analyse_files(cfg, not args.keep_old, args.meta_only)
+    if args.rebuild and not 'json_cache' in cfg:
+        _LOGGER.error("'json_cache' must be set to rebuild DB")
+        exit(-1)
+    if args.worker is not None:
+        cluster.run_worker(cfg, args.worker)
+    elif args.coordinator:
+        cluster.run_coordinator(cfg, not args.keep_old)
+    elif args.watch:
+        if args.rebuild:
+            _LOGGER.error("'--watch' and '--rebuild' cannot be used together")
+            exit(-1)
+        watch.watch_files(cfg, not args.keep_old, args.meta_only)
+    else:
+        analysis.analyse_files(cfg, not args.keep_old, args.meta_only, args.rebuild)
 
@@ -5,171 +5,439 @@
 # GPLv3 license.
 #
 
-import gzip
+import functools
+import heapq
 import json
 import logging
+import multiprocessing
 import os
-import pathlib
-import sqlite3
-import subprocess
+import queue
 import tempfile
-from . import cue, tracks_db, tags
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from . import cache, cue, dedup, extractor, features, journal, metrics, scheduler, tracks_db, tags
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 _LOGGER = logging.getLogger(__name__)
 AUDIO_EXTENSIONS = ['m4a', 'mp3', 'ogg', 'flac']
+# Seconds for discovery to wait for space in queue, before checking if it should stop
+QUEUE_PUT_TIMEOUT = 1
 
 
-def get_files_to_analyse(db, lms_db, lms_path, path, files, essentia_root_len, tmp_path, tmp_path_len, meta_only):
+class AnalysisError(Exception):
+    pass
+
+
+class DirSnapshot(object):
+    # Relative paths of all music files seen during discovery, used to remove
+    # tracks that no longer exist. Only valid if the whole tree was read.
+    def __init__(self):
+        self.files = set()
+        self.complete = False
+        self.errors = 0
+
+
+def get_file_tracks(analysed, lms_meta, lms_path, path, st, has_cue, essentia_root_len, tmp_path, tmp_path_len, meta_only):
+    # Tracks of a music file (more than one if it has a CUE file) that need updating
+    db_path = path[essentia_root_len:]
+    state = tracks_db.file_state(db_path, st)
+    changed = analysed.state_changed(state, meta_only)
+    if has_cue:
+        # Metadata of CUE tracks is read from LMS's DB, not the music file, so
+        # is always re-checked (which is just a lookup) when updating metadata.
+        tracks = [track for track in cue.get_cue_tracks(lms_meta, lms_path, path, essentia_root_len, tmp_path) if changed or meta_only or not analysed.contains(track['file'][tmp_path_len:])]
+        for track in tracks:
+            yield {'abs':track['file'], 'db':track['file'][tmp_path_len:], 'track':track, 'src':path, 'state':state}
+        if len(tracks)>0:
+            return
+    elif changed or (not meta_only and not analysed.contains(db_path)):
+        yield {'abs':path, 'db':db_path, 'state':state}
+        return
+    if not meta_only and analysed.state_unknown(state):
+        # Analysed before file states were stored, so store current state - so
+        # that later changes are detected.
+        analysed.db.set_file_state(state, True)
+
+
+def get_files_to_analyse(analysed, lms_meta, lms_path, path, essentia_root_len, tmp_path, tmp_path_len, meta_only, snapshot=None):
     if not os.path.exists(path):
         _LOGGER.error("'%s' does not exist" % path)
         return
-    if os.path.isdir(path):
-        for e in sorted(os.listdir(path)):
-            get_files_to_analyse(db, lms_db, lms_path, os.path.join(path, e), files, essentia_root_len, tmp_path, tmp_path_len, meta_only)
-    parts = path.rsplit('.', 1)
-    if len(parts)>1 and parts[1].lower() in AUDIO_EXTENSIONS:
-        if os.path.exists(parts[0]+'.cue'):
-            for track in cue.get_cue_tracks(lms_db, lms_path, path, essentia_root_len, tmp_path):
-                if meta_only or not db.file_already_analysed(track['file'][tmp_path_len:]):
-                    files.append({'abs':track['file'], 'db':track['file'][tmp_path_len:], 'track':track, 'src':path})
-        elif meta_only or not db.file_already_analysed(path[essentia_root_len:]):
-            files.append({'abs':path, 'db':path[essentia_root_len:]})
-
-
-def read_json_file(js, db_path, abs_path, cue_track):
     try:
-        data = json.load(js)
-
-        resp = {
-                  'path': db_path,
-                  'tags': tags.read_tags(abs_path, tracks_db.GENRE_SEPARATOR) if cue_track is None else cue_track['meta'],
-                  'danceable': float(data['highlevel']['danceability']['all']['danceable']),
-                  'aggressive': float(data['highlevel']['mood_aggressive']['all']['aggressive']),
-                  'electronic': float(data['highlevel']['mood_electronic']['all']['electronic']),
-                  'acoustic': float(data['highlevel']['mood_acoustic']['all']['acoustic']),
-                  'happy': float(data['highlevel']['mood_happy']['all']['happy']),
-                  'party': float(data['highlevel']['mood_party']['all']['party']),
-                  'relaxed': float(data['highlevel']['mood_relaxed']['all']['relaxed']),
-                  'sad': float(data['highlevel']['mood_sad']['all']['sad']),
-                  'dark': float(data['highlevel']['timbre']['all']['dark']),
-                  'tonal': float(data['highlevel']['tonal_atonal']['all']['tonal']),
-                  'voice': float(data['highlevel']['voice_instrumental']['all']['voice']),
-                  'bpm': int(data['rhythm']['bpm'])
-                }
-        return resp
+        entries = sorted(os.scandir(path), key=lambda e: e.name)
+    except OSError as e:
+        _LOGGER.error("Failed to read '%s' - %s" % (path, str(e)))
+        if snapshot is not None:
+            snapshot.errors += 1
+        return
+    names = set(e.name for e in entries)
+    for e in entries:
+        if e.is_dir():
+            yield from get_files_to_analyse(analysed, lms_meta, lms_path, e.path, essentia_root_len, tmp_path, tmp_path_len, meta_only, snapshot)
+            continue
+        parts = e.name.rsplit('.', 1)
+        if len(parts)>1 and parts[1].lower() in AUDIO_EXTENSIONS:
+            if snapshot is not None:
+                snapshot.files.add(e.path[essentia_root_len:])
+            yield from get_file_tracks(analysed, lms_meta, lms_path, e.path, e.stat(), parts[0]+'.cue' in names, essentia_root_len, tmp_path, tmp_path_len, meta_only)
+
+
+def stop_requested(config):
+    return 'stop' in config and os.path.exists(config['stop'])
+
+
+def put_file(files_queue, f, stop):
+    # Returns False if stop was set before there was space in the queue
+    while not stop.is_set():
+        try:
+            files_queue.put(f, timeout=QUEUE_PUT_TIMEOUT)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def discover_files(config, files_queue, stop, lms_meta, tmp_path, meta_only, snapshot):
+    # Runs in its own thread, so needs its own DB connection. stop is set if
+    # the main thread is no longer reading the queue.
+    db = tracks_db.TracksDb(config)
+    count = 0
+    start = time.monotonic()
+    try:
+        analysed = tracks_db.AnalysedFiles(db, config['lookup_per_folder'], config['check_inode'])
+        for f in get_files_to_analyse(analysed, lms_meta, config['lms'], config['essentia'], len(config['essentia']), tmp_path+'/', len(tmp_path)+1, meta_only, snapshot):
+            if stop_requested(config) or not put_file(files_queue, f, stop):
+                break
+            count += 1
+            metrics.count('files_found')
+        else:
+            if snapshot is not None:
+                snapshot.complete = True
+    except Exception as e:
+        _LOGGER.error('Discovery failed - %s' % str(e))
+    finally:
+        # Includes time spent waiting for space in the queue
+        metrics.record('discovery', time.monotonic()-start)
+        _LOGGER.debug('Discovery finished, found %d tracks to update' % count)
+        put_file(files_queue, None, stop)
+        db.close()
+
+
+def read_queue(files_queue):
+    while True:
+        f = files_queue.get()
+        metrics.gauge('files_queue', files_queue.qsize())
+        if f is None:
+            return
+        yield f
+
+
+def get_response(db_path, abs_path, meta, values):
+    resp = {'path': db_path, 'tags': tags.read_tags(abs_path, tracks_db.GENRE_SEPARATOR) if meta is None else meta}
+    resp.update(values)
+    return resp
+
+
+def read_json_file(js, db_path, abs_path, meta):
+    try:
+        return get_response(db_path, abs_path, meta, cache.get_values(json.load(js)))
     except ValueError:
         return None
 
 
-def analyse_track(idx, db_path, abs_path, cue_track, tmp_path, config, total):
-    if 'stop' in config and os.path.exists(config['stop']):
+def progress(idx, total):
+    if total is None:
+        return '[{}]'.format(idx)
+    return '[{}/{} {}%]'.format(idx, total, int(idx*100/total))
+
+
+def analyse_track(idx, f, tmp_path, config, total):
+    if stop_requested(config):
         return None
 
-    pc = int(idx*100/total)
-    # Try to load previous JSON
-    if 'json_cache' in config:
-        jsfile = "%s/%s.json" % (config['json_cache'], db_path)
-        jsfileGz = "%s.gz" % jsfile
-        if os.path.exists(jsfile):
-            # Plain, uncompressed
-            with open(jsfile, 'r') as js:
-                resp = read_json_file(js, db_path, abs_path, cue_track)
-                if resp is not None:
-                    _LOGGER.debug("[{}/{} {}%] Using cached analyze results for {}".format(idx, total, pc, db_path))
-                    return resp
-        elif os.path.exists(jsfileGz):
-            # GZIP compressed
-            with gzip.open(jsfileGz, 'r') as js:
-                resp = read_json_file(js, db_path, abs_path, cue_track)
-                if resp is not None:
-                    _LOGGER.debug("[{}/{} {}%] Using cached analyze results for {}".format(idx, total, pc, db_path))
-                    return resp
-
-        path = jsfile[:-(len(os.path.basename(jsfile)))-1]
-        if not os.path.exists(path):
-            try:
-                os.makedirs(path)
-            except:
-                pass
+    db_path = f['db']
+    abs_path = f['abs']
+    cue_track = f['track'] if 'track' in f else None
+    # Metadata may already have been read, for CUE tracks or longest first ordering
+    meta = cue_track['meta'] if cue_track is not None else (f['meta'] if 'meta' in f else None)
+    prog = progress(idx, total)
+    # Same audio as a track already in DB
+    if 'values' in f:
+        _LOGGER.debug("{} Using results of identical track for {}".format(prog, db_path))
+        return get_response(db_path, abs_path, meta, f['values'])
+    # Try to load previous results
+    json_cache = cache.get_cache(config)
+    if json_cache is not None:
+        values = json_cache.get(db_path)
+        if values is not None:
+            _LOGGER.debug("{} Using cached analyze results for {}".format(prog, db_path))
+            metrics.count('tracks_cached')
+            return get_response(db_path, abs_path, meta, values)
+    # Results of a previous run, that were not stored in DB
+    journal_file = journal.get_file(config, db_path) if config['journal'] else None
+    if journal_file is not None:
+        values = journal.read_values(journal_file)
+        if values is not None:
+            _LOGGER.debug("{} Using results of previous run for {}".format(prog, db_path))
+            return get_response(db_path, abs_path, meta, values)
+
+    jsfile = "%s/essentia-%d.json" % (tmp_path, idx)
+    split_path = None
+    try:
+        if cue_track is not None:
+            # CUE tracks are split just before analysis, and removed straight after
+            split_path = cue.split_cue_track(f['src'], cue_track, config['cue_format'])
+        _LOGGER.debug('{} Analyzing: {}'.format(prog, db_path))
+        values = extractor.get_extractor(config).analyse(abs_path if split_path is None else split_path, jsfile)
+        if values is None:
+            _LOGGER.error('{} Analysis of {} failed'.format(prog, db_path))
+            raise AnalysisError('Extractor failed')
+        if json_cache is not None:
+            json_cache.put(db_path, jsfile, values)
+        if journal_file is not None:
+            journal.write_values(journal_file, values)
+        return get_response(db_path, abs_path, meta, values)
+    finally:
+        for path in [split_path, jsfile]:
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+
+def get_duration(f):
+    # Duration of track, in seconds. Metadata is stored so that it is not read
+    # again during analysis.
+    if 'track' in f:
+        return f['track']['meta']['duration']
+    f['meta'] = tags.read_tags(f['abs'], tracks_db.GENRE_SEPARATOR)
+    if f['meta'] is not None and f['meta']['duration']>0:
+        return f['meta']['duration']
+    # Unknown, so estimate from size assuming 128kbps
+    return f['state'][1]/16000
+
+
+def longest_first(files, config):
+    # Order tracks so that the longest are analysed first, so that a few long
+    # tracks don't leave a single thread busy at the end of a run.
+    if isinstance(files, list):
+        with ThreadPoolExecutor(max_workers=config['threads']) as executor:
+            durations = list(executor.map(get_duration, files))
+        for duration, idx in sorted(((durations[i], i) for i in range(len(files))), reverse=True):
+            yield files[idx]
     else:
-        jsfile = "%s/essentia-%d.json" % (tmp_path, idx)
+        # Streaming, so only consider the next 'queue_size' tracks
+        heap = []
+        for idx, f in enumerate(files):
+            heapq.heappush(heap, (-get_duration(f), idx, f))
+            if len(heap)>=config['queue_size']:
+                yield heapq.heappop(heap)[2]
+        while len(heap)>0:
+            yield heapq.heappop(heap)[2]
+
 
-    if not os.path.exists(jsfile):
-        _LOGGER.debug('[{}/{} {}%] Analyzing: {}'.format(idx, total, pc, db_path))
-        subprocess.call([config['extractor'], abs_path, jsfile, 'profile'], shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=pathlib.Path(__file__).parent.parent.absolute())
-    if not os.path.exists(jsfile):
-        _LOGGER.error('[{}/{} {}%] Analysis of {} failed, no JSON created'.format(idx, total, pc, db_path))
+def rebuild_track(idx, f, tmp_path, config, total):
+    # Runs in a separate process. Only uses cached results, extractor is not run.
+    values = cache.get_cache(config).get(f['db'])
+    if values is None:
+        _LOGGER.debug('{} No cached results for {}'.format(progress(idx, total), f['db']))
         return None
-    try:
-        resp = None
-        with open(jsfile, 'r') as js:
-            resp = read_json_file(js, db_path, abs_path, cue_track)
-        if 'json_cache' in config:
-            try:
-                subprocess.call(['gzip', jsfile])
-            except:
-                pass # Don't throw errors - as may not have gzip?
-        else:
-            os.remove(jsfile)
-        return resp
-    except ValueError:
-        _LOGGER.error('Failed to parse %s for %s' % (jsfile, db_path))
-    return None
-
-
-def analyse_tracks(db, allfiles, tmp_path, config, total):
-    numtracks = len(allfiles)
-    futures_list = []
-    count_since_save = 0
-    with ThreadPoolExecutor(max_workers=config['threads']) as executor:
-        for i in range(numtracks):
-            cue_track = allfiles[i]['track'] if 'track' in allfiles[i] else None
-            futures = {'exe': executor.submit(analyse_track, i+1, allfiles[i]['db'], allfiles[i]['abs'], cue_track, tmp_path, config, total), 'path':allfiles[i]['db']}
-            futures_list.append(futures)
-        for future in futures_list:
+    cue_track = f['track'] if 'track' in f else None
+    return get_response(f['db'], f['abs'], cue_track['meta'] if cue_track is not None else None, values)
+
+
+def get_track_row(idx, f, tmp_path, config, total, rebuild):
+    # Runs in a thread or process, returns only the DB row - as this is smaller to
+    # pass back from a process - and the time taken by each stage.
+    with metrics.capture() as stages:
+        result = rebuild_track(idx, f, tmp_path, config, total) if rebuild else analyse_track(idx, f, tmp_path, config, total)
+    return None if result is None else (tracks_db.get_row(result), stages)
+
+
+def get_meta_row(idx, f, config):
+    _LOGGER.debug('Updating metadata for %s' % f['abs'])
+    with metrics.capture() as stages:
+        meta = f['track']['meta'] if 'track' in f and 'meta' in f['track'] else tags.read_tags(f['abs'], tracks_db.GENRE_SEPARATOR)
+    return None if meta is None else (tracks_db.get_meta(meta) + (f['db'],), stages)
+
+
+def get_process_executor(max_workers):
+    # Discovery and metrics threads may be running, and forking a process with
+    # threads can deadlock - so processes are started from a fork server.
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('forkserver'))
+
+
+def get_executor(config, max_workers):
+    if config['processes']:
+        return get_process_executor(max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+
+def process_tracks(db, allfiles, executor, func, store, config, adaptive=None, started=None, failed=None):
+    # Call func(idx, f) for each track, keeping at most config['in_flight'] tracks
+    # submitted, and call store(f, result) as each completes - so that finished
+    # rows are not held behind a slow track. If adaptive is set, the number
+    # submitted follows its limit. If set, started(f) is called as each track is
+    # submitted, and failed(f, reason) if there is no result - reason is None if
+    # func did not fail (e.g. stop was requested). Progress is logged every
+    # config['metrics_interval'] seconds.
+    in_flight = {}
+
+    def handle_completed():
+        done, _ = wait(in_flight, timeout=config['db_batch_interval'], return_when=FIRST_COMPLETED)
+        for future in done:
+            f, start = in_flight.pop(future)
+            if adaptive is not None:
+                adaptive.job_done(time.monotonic()-start)
+            metrics.count('tracks_done')
             try:
-                result = future['exe'].result()
-                if result:
-                    count_since_save += 1
-                    db.add(result)
-                    if count_since_save >= 750:
-                        _LOGGER.debug('Commiting DB changes')
-                        db.commit()
-                        count_since_save = 0
+                result = future.result()
             except Exception as e:
-                _LOGGER.debug("%s - Thread exception? - %s (%s)" % (future['path'], str(e)))
-                pass
+                _LOGGER.debug("%s - Thread exception? - %s" % (f['db'], str(e)))
+                metrics.count('tracks_failed')
+                if failed is not None:
+                    failed(f, str(e))
+                continue
+            # Not within above try, so that failure to write to the DB stops the run
+            if result:
+                store(f, result)
+            elif failed is not None:
+                failed(f, None)
+        metrics.gauge('in_flight', len(in_flight))
+        # Buffered rows are written every db_batch_size rows, or db_batch_interval seconds
+        db.flush_if_due()
+        metrics.METRICS.report_if_due(config['metrics_interval'])
 
+    with executor:
+        for i, f in enumerate(allfiles):
+            while len(in_flight)>=(config['in_flight'] if adaptive is None else adaptive.limit):
+                handle_completed()
+            if started is not None:
+                started(f)
+            in_flight[executor.submit(func, i+1, f)] = (f, time.monotonic())
+        while len(in_flight)>0:
+            handle_completed()
 
-def update_db(db, files):
-    for f in files:
-        _LOGGER.debug('Updating metadata for %s' % f['abs'])
-        meta = f['track']['meta'] if 'track' in f and 'meta' in f['track'] else tags.read_tags(f['abs'], tracks_db.GENRE_SEPARATOR)
-        db.update({'path':f['db'], 'tags':meta})
+
+def analyse_tracks(db, allfiles, tmp_path, config, total, rebuild=False):
+    # When rebuilding from the cache the work is all Python, so processes are
+    # always used rather than threads.
+    adaptive = scheduler.AdaptiveLimit(config) if config['adaptive_threads'] and not rebuild else None
+    if rebuild:
+        executor = get_process_executor(config['threads'])
+    else:
+        executor = get_executor(config, config['threads'] if adaptive is None else adaptive.max)
+
+    use_journal = config['journal'] and not rebuild
+
+    def store(f, result):
+        row, stages = result
+        metrics.merge(stages)
+        db.add_row(row)
+        db.set_file_state(f['state'], True)
+        if 'hash' in f and f['hash'] is not None:
+            db.set_file_hash(f['db'], f['hash'])
+        if use_journal:
+            db.end_job(f['db'], 'done', None, journal.get_file(config, f['db']))
+
+    def started(f):
+        db.start_job(f['db'], f['state'])
+
+    def failed(f, reason):
+        db.end_job(f['db'], 'queued' if reason is None else 'failed', reason)
+
+    if use_journal:
+        os.makedirs(journal.get_folder(config), exist_ok=True)
+        process_tracks(db, allfiles, executor, functools.partial(get_track_row, tmp_path=tmp_path, config=config, total=total, rebuild=rebuild), store, config, adaptive, started, failed)
+    else:
+        process_tracks(db, allfiles, executor, functools.partial(get_track_row, tmp_path=tmp_path, config=config, total=total, rebuild=rebuild), store, config, adaptive)
 
 
-def analyse_files(config, remove_tracks, meta_only):
+def update_db(db, files, config):
+    # Tags are read in parallel, and only rows whose metadata has changed are
+    # written. Returns number of rows updated.
+    counts = {'updated':0, 'unchanged':0}
+
+    def store(f, result):
+        row, stages = result
+        metrics.merge(stages)
+        stored = db.get_track_meta(f['db'])
+        if stored is not None and stored!=row[:-1]:
+            db.update_row(row)
+            counts['updated'] += 1
+        else:
+            counts['unchanged'] += 1
+        db.set_file_state(f['state'], False)
+
+    process_tracks(db, files, get_executor(config, config['threads']), functools.partial(get_meta_row, config=config), store, config)
+    _LOGGER.info('Updated metadata of %d tracks, %d unchanged' % (counts['updated'], counts['unchanged']))
+    return counts['updated']
+
+
+def analyse_files(config, remove_tracks, meta_only, rebuild=False):
     _LOGGER.debug('Music path: %s' % config['essentia'])
     db = tracks_db.TracksDb(config)
-    lms_db = sqlite3.connect(config['lmsdb']) if 'lmsdb' in config else None
     temp_dir = config['tmp'] if 'tmp' in config else None
-    removed_tracks = db.remove_old_tracks(config['essentia']) if remove_tracks else False
+    snapshot = DirSnapshot() if remove_tracks else None
+    server = metrics.start(config)
+    with metrics.timer('cue_metadata'):
+        lms_meta = cue.LmsCueMetadata(config['lmsdb']) if 'lmsdb' in config else None
 
     with tempfile.TemporaryDirectory(dir=temp_dir) as tmp_path:
         _LOGGER.debug('Temp folder: %s' % tmp_path)
-        files=[]
-        get_files_to_analyse(db, lms_db, config['lms'], config['essentia'], files, len(config['essentia']), tmp_path+'/', len(tmp_path)+1, meta_only)
-        _LOGGER.debug('Num tracks to update: %d' % len(files))
-        if not meta_only:
-            cue.split_cue_tracks(files, config['threads'])
-        num_to_analyze = len(files)
-        if num_to_analyze>0 or removed_tracks:
-            if num_to_analyze>0:
-                if meta_only:
-                    update_db(db, files)
-                else:
-                    analyse_tracks(db, files, tmp_path, config, num_to_analyze)
-            db.commit()
-            db.close()
+        if config['stream']:
+            # Discovery runs in a separate thread, feeding a bounded queue.
+            files_queue = queue.Queue(maxsize=config['queue_size'])
+            stop = threading.Event()
+            discovery = threading.Thread(target=discover_files, args=(config, files_queue, stop, lms_meta, tmp_path, meta_only, snapshot))
+            discovery.start()
+            files = read_queue(files_queue)
+            total = None
+            if config['journal'] and not meta_only and not rebuild:
+                files = journal.filter_files(db, files, config)
+            if config['dedup'] and not meta_only and not rebuild:
+                files = dedup.filter_files(db, files, config)
+        else:
+            with metrics.timer('discovery'):
+                analysed = tracks_db.AnalysedFiles(db, config['lookup_per_folder'], config['check_inode'])
+                files = list(get_files_to_analyse(analysed, lms_meta, config['lms'], config['essentia'], len(config['essentia']), tmp_path+'/', len(tmp_path)+1, meta_only, snapshot))
+            if snapshot is not None:
+                snapshot.complete = True
+            if config['journal'] and not meta_only and not rebuild:
+                files = list(journal.filter_files(db, files, config))
+            if config['dedup'] and not meta_only and not rebuild:
+                files = list(dedup.filter_files(db, files, config))
+            total = len(files)
+            metrics.count('files_found', total)
+            metrics.set_total(total)
+            _LOGGER.debug('Num tracks to update: %d' % total)
+        try:
+            if meta_only:
+                update_db(db, files, config)
+            elif rebuild:
+                analyse_tracks(db, files, tmp_path, config, total, True)
+            else:
+                if config['longest_first']:
+                    files = longest_first(files, config)
+                analyse_tracks(db, files, tmp_path, config, total)
+        finally:
+            if config['stream']:
+                # Discovery may be blocked on a full queue, if analysis failed
+                stop.set()
+                discovery.join()
+        if snapshot is not None:
+            if snapshot.complete and snapshot.errors==0 and len(snapshot.files)>0:
+                db.remove_old_tracks(snapshot.files)
+            else:
+                _LOGGER.warning('Music folder was not fully read, not removing old tracks')
+        db.commit()
+        db.close()
+    metrics.finish(config, server)
+    export_features(config)
     _LOGGER.debug('Finished analysis')
+
+
+def export_features(config):
+    if 'features' in config:
+        try:
+            features.export_features(config['db'], config['features'], config['feature_partitions'])
+        except ImportError:
+            _LOGGER.error('numpy is required to export features')
@@ -0,0 +1,149 @@
+#
+# Analyse files with Essentia
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import gzip
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import zlib
+
+_LOGGER = logging.getLogger(__name__)
+PACKED_CACHE_FILE = 'essentia-cache.db'
+# Values read from extractor output - (name, highlevel model, class)
+HIGHLEVEL_VALUES = [('danceable',  'danceability',       'danceable'),
+                    ('aggressive', 'mood_aggressive',    'aggressive'),
+                    ('electronic', 'mood_electronic',    'electronic'),
+                    ('acoustic',   'mood_acoustic',      'acoustic'),
+                    ('happy',      'mood_happy',         'happy'),
+                    ('party',      'mood_party',         'party'),
+                    ('relaxed',    'mood_relaxed',       'relaxed'),
+                    ('sad',        'mood_sad',           'sad'),
+                    ('dark',       'timbre',             'dark'),
+                    ('tonal',      'tonal_atonal',       'tonal'),
+                    ('voice',      'voice_instrumental', 'voice')]
+
+
+def get_values(data):
+    # Extract the values we use from the extractor's JSON output
+    values = {}
+    for name, model, cls in HIGHLEVEL_VALUES:
+        values[name] = float(data['highlevel'][model]['all'][cls])
+    values['bpm'] = int(data['rhythm']['bpm'])
+    return values
+
+
+def read_values(js):
+    # Read values from extractor JSON file. If ijson is installed the file is
+    # parsed incrementally, so that the whole document is not loaded.
+    try:
+        import ijson
+    except ImportError:
+        return get_values(json.load(js))
+
+    wanted = {'highlevel.%s.all.%s' % (model, cls):name for name, model, cls in HIGHLEVEL_VALUES}
+    wanted['rhythm.bpm'] = 'bpm'
+    values = {}
+    try:
+        for prefix, event, value in ijson.parse(js):
+            if prefix in wanted and 'number'==event:
+                values[wanted[prefix]] = int(value) if 'rhythm.bpm'==prefix else float(value)
+                if len(values)==len(wanted):
+                    return values
+    except ijson.JSONError as e:
+        raise ValueError(str(e))
+    raise KeyError('Missing values')
+
+
+class FileCache(object):
+    # One (gzip compressed) extractor JSON file per track, stored using the
+    # track's path.
+    def __init__(self, path):
+        self.path = path
+
+
+    def get(self, db_path):
+        jsfile = "%s/%s.json" % (self.path, db_path)
+        try:
+            if os.path.exists(jsfile):
+                with open(jsfile, 'rb') as js:
+                    return read_values(js)
+            if os.path.exists(jsfile+'.gz'):
+                with gzip.open(jsfile+'.gz', 'rb') as js:
+                    return read_values(js)
+        except (ValueError, KeyError, OSError):
+            pass
+        return None
+
+
+    def put(self, db_path, jsfile, values):
+        cached = "%s/%s.json.gz" % (self.path, db_path)
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        with open(jsfile, 'rb') as src, gzip.open(cached, 'wb') as dest:
+            shutil.copyfileobj(src, dest)
+
+
+    def close(self):
+        pass
+
+
+class PackedCache(object):
+    # Single SQLite file, storing only the values we use, zlib compressed, keyed
+    # on track path. Tracks not found are looked for in a FileCache, and stored
+    # if found - so older caches are converted as they are used.
+    def __init__(self, path):
+        self.path = path
+        self.files = FileCache(path)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(path, PACKED_CACHE_FILE), check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS analysis (file varchar PRIMARY KEY NOT NULL, data blob)')
+        self.conn.commit()
+
+
+    def get(self, db_path):
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM analysis WHERE file=?', (db_path, )).fetchone()
+        if row is not None:
+            return json.loads(zlib.decompress(row[0]))
+        values = self.files.get(db_path)
+        if values is not None:
+            self.store(db_path, values)
+        return values
+
+
+    def put(self, db_path, jsfile, values):
+        self.store(db_path, values)
+
+
+    def store(self, db_path, values):
+        data = zlib.compress(json.dumps(values, separators=(',', ':')).encode())
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO analysis (file, data) VALUES (?, ?)', (db_path, data))
+            self.conn.commit()
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cache(config):
+    # Cache for current process, None if not configured
+    if not 'json_cache' in config:
+        return None
+    pid = os.getpid()
+    with _caches_lock:
+        if not pid in _caches:
+            _caches[pid] = PackedCache(config['json_cache']) if 'packed'==config['json_cache_format'] else FileCache(config['json_cache'])
+        return _caches[pid]
@@ -0,0 +1,249 @@
+#
+# Analyse files with Essentia
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+# Analysis spread across machines. The coordinator finds the files to analyse,
+# and hands these out to workers (each with their own view of the music folder)
+# over HTTP. Workers send back DB rows, which the coordinator alone writes to the
+# DB. Each item is leased to a worker for 'lease_time' seconds, after which it
+# is given to another worker - so items of workers that die are not lost.
+
+import collections
+import itertools
+import json
+import logging
+import os
+import queue
+import socket
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import analysis, cue, tracks_db
+
+_LOGGER = logging.getLogger(__name__)
+# Seconds for a worker to wait when all items are leased, but not finished
+WAIT_INTERVAL = 5
+# Seconds for a worker to keep retrying if coordinator cannot be reached
+RETRY_TIME = 60
+# Length of a row, as returned by tracks_db.get_row()
+ROW_LENGTH = len(tracks_db.META_COLUMNS)+len(tracks_db.SCORE_COLUMNS)+1
+
+
+class WorkQueue(object):
+    def __init__(self, files, lease_time, essentia_root_len):
+        self.lock = threading.Lock()
+        self.items = {i:f for i, f in enumerate(files)}
+        self.pending = collections.deque(range(len(files)))
+        # Item id to (lease id, expiry time, worker name)
+        self.leases = {}
+        self.lease_time = lease_time
+        self.lease_ids = itertools.count(1)
+        self.essentia_root_len = essentia_root_len
+        self.remaining = len(files)
+        self.finished = False
+        # (f, row, worker) of completed items, row is None if analysis failed
+        self.results = queue.Queue()
+
+
+    def expire(self):
+        now = time.monotonic()
+        with self.lock:
+            for item_id in [item_id for item_id, lease in self.leases.items() if lease[1]<now]:
+                _LOGGER.warning('Lease of %s by %s expired' % (self.items[item_id]['db'], self.leases[item_id][2]))
+                del self.leases[item_id]
+                self.pending.appendleft(item_id)
+
+
+    def lease(self, worker):
+        # Only paths relative to the music folder are sent, as workers may have
+        # it mounted elsewhere.
+        with self.lock:
+            if self.finished or len(self.pending)==0:
+                return None
+            item_id = self.pending.popleft()
+            lease_id = next(self.lease_ids)
+            self.leases[item_id] = (lease_id, time.monotonic()+self.lease_time, worker)
+            f = self.items[item_id]
+            item = {'id':item_id, 'lease':lease_id, 'db':f['db']}
+            if 'track' in f:
+                item['src'] = f['src'][self.essentia_root_len:]
+                item['track'] = {'start':f['track']['start'], 'end':f['track']['end'], 'meta':f['track']['meta']}
+            return item
+
+
+    def complete(self, item_id, row, worker):
+        # Results are accepted even if lease has expired, as long as the item
+        # has not already been completed. Malformed rows are rejected, as these
+        # would cause the DB write to fail.
+        with self.lock:
+            if not item_id in self.items:
+                return False
+            if row is not None and (not isinstance(row, list) or len(row)!=ROW_LENGTH or row[0]!=self.items[item_id]['db']):
+                _LOGGER.warning('Invalid result for %s from %s' % (self.items[item_id]['db'], worker))
+                return False
+            f = self.items.pop(item_id)
+            if self.leases.pop(item_id, None) is None and item_id in self.pending:
+                self.pending.remove(item_id)
+            self.remaining -= 1
+        self.results.put((f, row, worker))
+        return True
+
+
+class CoordinatorHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            req = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            work = self.server.work
+            if '/lease'==self.path:
+                item = work.lease(req['worker'])
+                resp = {'item':item, 'finished':item is None and work.finished}
+            elif '/result'==self.path:
+                resp = {'accepted':work.complete(req['id'], req['row'], req['worker'])}
+            else:
+                self.send_error(404)
+                return
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_error(400, str(e))
+            return
+        body = json.dumps(resp).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        _LOGGER.debug('%s %s' % (self.address_string(), format % args))
+
+
+def run_coordinator(config, remove_tracks):
+    _LOGGER.debug('Music path: %s' % config['essentia'])
+    db = tracks_db.TracksDb(config)
+    snapshot = analysis.DirSnapshot() if remove_tracks else None
+    lms_meta = cue.LmsCueMetadata(config['lmsdb']) if 'lmsdb' in config else None
+    with tempfile.TemporaryDirectory(dir=config['tmp'] if 'tmp' in config else None) as tmp_path:
+        # Temporary folder is only used to name CUE tracks
+        analysed = tracks_db.AnalysedFiles(db, config['lookup_per_folder'], config['check_inode'])
+        files = list(analysis.get_files_to_analyse(analysed, lms_meta, config['lms'], config['essentia'], len(config['essentia']), tmp_path+'/', len(tmp_path)+1, False, snapshot))
+    if snapshot is not None:
+        snapshot.complete = True
+    total = len(files)
+
+    work = WorkQueue(files, config['lease_time'], len(config['essentia']))
+    server = ThreadingHTTPServer(('', config['coordinator_port']), CoordinatorHandler)
+    server.work = work
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    _LOGGER.info('Waiting for workers to analyse %d tracks, listening on port %d' % (total, config['coordinator_port']))
+
+    done = 0
+    try:
+        while work.remaining>0 or not work.results.empty():
+            if analysis.stop_requested(config):
+                _LOGGER.info('Stop requested')
+                break
+            try:
+                f, row, worker = work.results.get(timeout=min(WAIT_INTERVAL, config['db_batch_interval']))
+                done += 1
+                if row:
+                    _LOGGER.debug('%s Analysed %s on %s' % (analysis.progress(done, total), f['db'], worker))
+                    db.add_row(tuple(row))
+                    db.set_file_state(f['state'], True)
+                else:
+                    _LOGGER.error('%s Analysis of %s on %s failed' % (analysis.progress(done, total), f['db'], worker))
+            except queue.Empty:
+                pass
+            work.expire()
+            db.flush_if_due()
+    finally:
+        # Keep serving for a while, so that idle workers are told to finish
+        work.finished = True
+        time.sleep(WAIT_INTERVAL*2)
+        server.shutdown()
+        server.server_close()
+
+    if snapshot is not None:
+        if work.remaining==0 and snapshot.errors==0 and len(snapshot.files)>0:
+            db.remove_old_tracks(snapshot.files)
+        else:
+            _LOGGER.warning('Analysis did not complete, not removing old tracks')
+    db.commit()
+    db.close()
+    analysis.export_features(config)
+    _LOGGER.debug('Finished analysis')
+
+
+def post(url, req):
+    data = json.dumps(req).encode()
+    request = urllib.request.Request(url, data=data, headers={'Content-Type':'application/json'})
+    with urllib.request.urlopen(request, timeout=60) as resp:
+        return json.loads(resp.read())
+
+
+def get_file(item, config, tmp_path):
+    # Convert item from coordinator into form used by analysis
+    f = {'abs':config['essentia']+item['db'], 'db':item['db']}
+    if 'track' in item:
+        track_file = '%s/%s' % (tmp_path, item['db'])
+        f['abs'] = track_file
+        f['src'] = config['essentia']+item['src']
+        f['track'] = dict(item['track'])
+        f['track']['file'] = track_file
+    return f
+
+
+def worker_thread(config, url, name, tmp_path, job_ids):
+    failed_since = None
+    while not analysis.stop_requested(config):
+        try:
+            resp = post(url+'/lease', {'worker':name})
+            failed_since = None
+        except (OSError, ValueError) as e:
+            if failed_since is None:
+                failed_since = time.monotonic()
+            elif time.monotonic()-failed_since>RETRY_TIME:
+                _LOGGER.error('Failed to contact coordinator - %s' % str(e))
+                return
+            time.sleep(WAIT_INTERVAL)
+            continue
+        if resp['finished']:
+            return
+        if resp['item'] is None:
+            time.sleep(WAIT_INTERVAL)
+            continue
+
+        item = resp['item']
+        row = None
+        try:
+            # Job id is only used to name temporary files
+            result = analysis.get_track_row(next(job_ids), get_file(item, config, tmp_path), tmp_path, config, None, False)
+            if result is not None:
+                row = result[0]
+        except Exception as e:
+            _LOGGER.error('Failed to analyse %s - %s' % (item['db'], str(e)))
+        try:
+            post(url+'/result', {'id':item['id'], 'lease':item['lease'], 'row':row, 'worker':name})
+        except (OSError, ValueError) as e:
+            # Item will be leased to another worker once this lease expires
+            _LOGGER.error('Failed to send result of %s - %s' % (item['db'], str(e)))
+
+
+def run_worker(config, url):
+    name = '%s-%d' % (socket.gethostname(), os.getpid())
+    # Results are stored by the coordinator, so journal is not used
+    config = dict(config, journal=False)
+    url = url.rstrip('/')
+    _LOGGER.info('Analysing tracks from %s, using %d threads' % (url, config['threads']))
+    job_ids = itertools.count(1)
+    with tempfile.TemporaryDirectory(dir=config['tmp'] if 'tmp' in config else None) as tmp_path:
+        threads = [threading.Thread(target=worker_thread, args=(config, url, name, tmp_path, job_ids)) for i in range(config['threads'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    _LOGGER.debug('Finished analysis')
@@ -27,7 +27,10 @@ def read_config(path):
         _LOGGER.error('Failed to read config file')
         exit(-1)
 
-    for key in ['extractor', 'essentia']:
+    if not 'extractor_backend' in config:
+        config['extractor_backend']='process'
+
+    for key in ['extractor', 'essentia'] if 'process'==config['extractor_backend'] else ['essentia']:
         if not key in config:
             _LOGGER.error("'%s' not in config file" % key)
             exit(-1)
@@ -41,7 +44,7 @@ def read_config(path):
             exit(-1)
 
     for key in config:
-        if key not in ['threads', 'extractor', 'db', 'lmsdb', 'stop', 'genres', 'ignoregenre', 'port', 'normalize'] and not config[key].endswith('/'):
+        if key not in ['threads', 'extractor', 'db', 'lmsdb', 'stop', 'genres', 'ignoregenre', 'port', 'normalize', 'stream', 'queue_size', 'in_flight', 'db_batch_size', 'db_batch_interval', 'db_cache_size', 'lookup_per_folder', 'check_inode', 'cue_format', 'adaptive_threads', 'min_threads', 'max_threads', 'min_free_memory', 'longest_first', 'json_cache_format', 'processes', 'extractor_backend', 'features', 'feature_partitions', 'compact_db', 'watch_delay', 'coordinator_port', 'lease_time', 'journal', 'max_retries', 'metrics_interval', 'metrics_file', 'metrics_port', 'dedup'] and not config[key].endswith('/'):
             config[key]=config[key]+'/'
 
     for path in ['tmp', 'json_cache']:
@@ -52,4 +55,79 @@ def read_config(path):
     if not 'threads' in config:
         config['threads']=os.cpu_count()
 
+    if not 'stream' in config:
+        config['stream']=False
+
+    if not 'queue_size' in config:
+        config['queue_size']=1000
+
+    if not 'in_flight' in config:
+        config['in_flight']=config['threads']*2
+
+    if not 'db_batch_size' in config:
+        config['db_batch_size']=500
+
+    if not 'db_batch_interval' in config:
+        config['db_batch_interval']=10
+
+    if not 'db_cache_size' in config:
+        config['db_cache_size']=65536
+
+    if not 'lookup_per_folder' in config:
+        config['lookup_per_folder']=False
+
+    if not 'check_inode' in config:
+        config['check_inode']=False
+
+    if not 'cue_format' in config:
+        config['cue_format']='wav'
+
+    if not 'adaptive_threads' in config:
+        config['adaptive_threads']=False
+
+    if not 'min_threads' in config:
+        config['min_threads']=1
+
+    if not 'max_threads' in config:
+        config['max_threads']=config['threads']
+
+    if not 'min_free_memory' in config:
+        config['min_free_memory']=1024
+
+    if not 'longest_first' in config:
+        config['longest_first']=False
+
+    if not 'json_cache_format' in config:
+        config['json_cache_format']='files'
+
+    if not 'processes' in config:
+        config['processes']=False
+
+    if not 'feature_partitions' in config:
+        config['feature_partitions']=0
+
+    if not 'compact_db' in config:
+        config['compact_db']=False
+
+    if not 'watch_delay' in config:
+        config['watch_delay']=30
+
+    if not 'coordinator_port' in config:
+        config['coordinator_port']=11001
+
+    if not 'lease_time' in config:
+        config['lease_time']=600
+
+    if not 'journal' in config:
+        config['journal']=False
+
+    if not 'max_retries' in config:
+        config['max_retries']=3
+
+    if not 'metrics_interval' in config:
+        config['metrics_interval']=60
+
+    if not 'dedup' in config:
+        config['dedup']=False
+
     return config
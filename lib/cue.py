@@ -9,93 +9,101 @@ import logging
 import os
 import sqlite3
 import subprocess
-from urllib.parse import quote
-from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote
+from . import metrics
 
 CUE_TRACK = '.CUE_TRACK.'
 _LOGGER = logging.getLogger(__name__)
 
-def get_cue_tracks(lms_db, lms_path, path, essentia_root_len, tmp_path):
+class LmsCueMetadata(object):
+    # Metadata of all CUE tracks in LMS's DB, read with a few queries up front
+    # and indexed by source file (as LMS sees it).
+    def __init__(self, lms_db_path):
+        self.tracks = {}
+        _LOGGER.debug('Reading CUE metadata from %s' % lms_db_path)
+        try:
+            conn = sqlite3.connect('file:%s?mode=ro&cache=shared' % quote(lms_db_path), uri=True)
+        except sqlite3.Error as e:
+            _LOGGER.error('Failed to open LMS DB - %s' % str(e))
+            return
+        try:
+            contributors = {}
+            for row in conn.execute("select ct.track, ct.role, c.name from contributor_track ct join contributors c on c.id=ct.contributor join tracks t on t.id=ct.track where t.url like '%#%'"):
+                contributors.setdefault(row[0], []).append((row[1], row[2]))
+            genres = {}
+            for row in conn.execute("select gt.track, g.name from genre_track gt join genres g on g.id=gt.genre join tracks t on t.id=gt.track where t.url like '%#%'"):
+                genres.setdefault(row[0], []).append(row[1])
+            for row in conn.execute("select t.url, t.title, t.id, a.title, t.secs from tracks t left join albums a on a.id=t.album where t.url like '%#%'"):
+                parts=row[0].split('#')
+                if 2!=len(parts):
+                    continue
+                times=parts[1].split('-')
+                if 2!=len(times):
+                    continue
+                track_artist=None
+                album_artist=None
+                for role, name in contributors.get(row[2], []):
+                    if track_artist is None and (1 == role or 6 == role):
+                        track_artist=name
+                    elif album_artist is None and 5 == role:
+                        album_artist=name
+                if album_artist is None:
+                    album_artist = track_artist
+                elif track_artist is None:
+                    track_artist = album_artist
+                if track_artist is not None and row[3] is not None:
+                    source = unquote(parts[0][7:] if parts[0].startswith('file://') else parts[0])
+                    self.tracks.setdefault(source, []).append({'start':times[0], 'end':times[1], 'meta':{'title':row[1], 'artist':track_artist, 'albumartist':album_artist, 'album':row[3], 'genres':genres.get(row[2], []), 'duration':int(row[4])}})
+        except sqlite3.Error as e:
+            _LOGGER.error('Failed to read CUE metadata from LMS DB - %s' % str(e))
+        finally:
+            conn.close()
+        _LOGGER.debug('Read metadata for %d CUE files' % len(self.tracks))
+
+
+    def get(self, lms_full_path):
+        return self.tracks.get(lms_full_path, [])
+
+
+def get_cue_tracks(lms_meta, lms_path, path, essentia_root_len, tmp_path):
     tracks=[]
-    if lms_db is not None:
-        _LOGGER.debug('Reading CUE metadata for %s' % path[essentia_root_len:])
+    if lms_meta is not None:
         # Convert essentia path into LMS path...
         lms_full_path = '%s%s' % (lms_path, path[essentia_root_len:])
-        # Get list of cue tracks from LMS db...
-        cursor = lms_db.execute("select url, title, id, album, secs from tracks where url like '%%%s#%%'" % quote(lms_full_path))
-        for row in cursor:
-            parts=row[0].split('#')
-            if 2==len(parts):
-                times=parts[1].split('-')
-                if 2==len(times):
-                    track_artist=None
-                    album_artist=None
-                    album_name=None
-                    contributors = lms_db.execute("select contributor, role from contributor_track where track=?", (row[2],)).fetchall()
-                    genres = lms_db.execute("select genre from genre_track where track=?", (row[2],)).fetchall()
-                    album = lms_db.execute("select title from albums where id=?", (row[3],)).fetchone()
-                    genre_list = []
-                    if albums is not None:
-                        album_name = album[0]
-                    if genres is not None:
-                        for g in genres:
-                            genre = lms_db.execute("select name from genres where id=?", (g[0],)).fetchone()
-                            if genre is not None:
-                                genre_list.append(genre[0])
-                    if contributors is not None:
-                        for cont in contributors:
-                            if track_artist is None and(1 == cont[1] or 6 == cont[1]):
-                                contributor = lms_db.execute("select name from contributors where id=?", (cont[0],)).fetchone()
-                                if contributor is not None:
-                                    track_artist=contributor[0]
-                            elif album_artist is None and 5 == cont[1]:
-                                contributor = lms_db.execute("select name from contributors where id=?", (cont[0],)).fetchone()
-                                if contributor is not None:
-                                    album_artist=contributor[0]
-                        if album_artist is None:
-                            album_artist = track_artist
-                        elif track_artist is None:
-                            track_artist = album_artist
-                    if track_artist is not None and album_name is not None:
-                        track_path='%s%s%s%s-%s.mp3' % (tmp_path, path[essentia_root_len:], CUE_TRACK, times[0], times[1])
-                        tracks.append({'file':track_path, 'start':times[0], 'end':times[1], 'meta':{'title':row[1], 'artist':track_artist, 'albumartist':album_artist, 'album':album_name, 'genres':genre_list, 'duration':int(row[4])}})
+        for track in lms_meta.get(lms_full_path):
+            track_path='%s%s%s%s-%s.mp3' % (tmp_path, path[essentia_root_len:], CUE_TRACK, track['start'], track['end'])
+            tracks.append({'file':track_path, 'start':track['start'], 'end':track['end'], 'meta':dict(track['meta'])})
     else:
         _LOGGER.debug("Can't get CUE tracks for %s - no LMS DB" % path)
     return tracks
 
 
-def split_cue_track(path, track):
-    _LOGGER.debug('Create %s' % track['file'])
-    dirname=os.path.dirname(track['file'])
+@metrics.timed('cue_split')
+def split_cue_track(path, track, cue_format):
+    # Returns path of the split track. 'file' is always named .mp3, as this is
+    # what is stored in the DB, but the split file may be of another format.
+    if 'copy'==cue_format:
+        split_path = '%s.%s' % (track['file'][:-4], path.rsplit('.', 1)[1])
+        codec = ['-c:a', 'copy']
+    elif 'wav'==cue_format:
+        split_path = '%s.wav' % track['file'][:-4]
+        codec = ['-c:a', 'pcm_s16le']
+    elif 'flac'==cue_format:
+        split_path = '%s.flac' % track['file'][:-4]
+        codec = ['-c:a', 'flac', '-compression_level', '0']
+    else:
+        split_path = track['file']
+        codec = ['-b:a', '128k']
+    _LOGGER.debug('Create %s' % split_path)
+    dirname=os.path.dirname(split_path)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname, exist_ok=True)
     end = float(track['end'])-float(track['start'])
-    command=['ffmpeg', '-hide_banner', '-loglevel', 'panic', '-i', path, '-b:a', '128k', '-ss', track['start'], '-t', "%f" % end, track['file']]
+    command=['ffmpeg', '-hide_banner', '-loglevel', 'panic', '-ss', track['start'], '-i', path, '-t', "%f" % end, '-vn'] + codec + [split_path]
     subprocess.Popen(command).wait()
-    return True
-
-
-def split_cue_tracks(files, num_threads):    
-    # Create temporary folders
-    for file in files:
-        if 'track' in file:
-            dirname=os.path.dirname(file['track']['file'])
-            if not os.path.exists(dirname):
-                os.makedirs(dirname)
+    return split_path
 
-    # Split into tracks
-    futures_list = []
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        for file in files:
-            if 'track' in file:
-                futures = executor.submit(split_cue_track, file['src'], file['track'])
-                futures_list.append(futures)
-        for future in futures_list:
-            try:
-                future.result()
-            except Exception as e:
-                _LOGGER.debug("Thread exception? - %s" % str(e))
-                pass
 
-                          
 def convert_to_cue_url(path):
     cue = path.find(CUE_TRACK)
     if cue>0:
@@ -0,0 +1,197 @@
+#
+# Analyse files with Essentia
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+# Detection of tracks with the same audio as one already analysed. A hash of
+# each file's audio data (i.e. ignoring any tags) is stored in 'file_state'.
+# Tracks whose hash matches that of a track in the DB use its results rather
+# than running the extractor, and if that track no longer exists it is treated
+# as having been moved.
+
+import hashlib
+import logging
+import os
+from . import metrics
+
+_LOGGER = logging.getLogger(__name__)
+# Only this much from the start, middle, and end, of the audio data is hashed
+SAMPLE_SIZE = 65536
+
+
+def get_id3_range(f, size):
+    start = 0
+    while True:
+        f.seek(start)
+        header = f.read(10)
+        if len(header)<10 or header[:3]!=b'ID3':
+            break
+        # Size is 'syncsafe' (7 bits per byte), and excludes header and footer
+        tag_size = (header[6]<<21)|(header[7]<<14)|(header[8]<<7)|header[9]
+        start += 10+tag_size+(10 if header[5]&0x10 else 0)
+    end = size
+    if end-start>=128:
+        f.seek(end-128)
+        if f.read(3)==b'TAG':
+            end -= 128
+    if end-start>=32:
+        f.seek(end-32)
+        footer = f.read(32)
+        if footer[:8]==b'APETAGEX':
+            # Size includes footer, but not header
+            end -= int.from_bytes(footer[12:16], 'little')+(32 if footer[23]&0x80 else 0)
+    return (start, end)
+
+
+def get_flac_range(f, size):
+    pos = 4
+    while True:
+        f.seek(pos)
+        header = f.read(4)
+        if len(header)<4:
+            return None
+        pos += 4+int.from_bytes(header[1:4], 'big')
+        if header[0]&0x80:
+            return (pos, size)
+
+
+def get_mp4_range(f, size):
+    pos = 0
+    while pos+8<=size:
+        f.seek(pos)
+        header = f.read(16)
+        atom_size = int.from_bytes(header[:4], 'big')
+        header_size = 8
+        if 1==atom_size:
+            atom_size = int.from_bytes(header[8:16], 'big')
+            header_size = 16
+        elif 0==atom_size:
+            atom_size = size-pos
+        if atom_size<header_size:
+            return None
+        if header[4:8]==b'mdat':
+            return (pos+header_size, min(size, pos+atom_size))
+        pos += atom_size
+    return None
+
+
+def read_ogg_page(f):
+    # Returns (granule position, payload), or None
+    header = f.read(27)
+    if len(header)<27 or header[:4]!=b'OggS':
+        return None
+    segments = f.read(header[26])
+    payload = f.read(sum(segments))
+    return (int.from_bytes(header[6:14], 'little'), payload)
+
+
+def get_ogg_hash(f, size):
+    # Tags are in the header pages, which alter the sequence number (and so
+    # checksum) of every later page - so only the payload of audio pages (those
+    # with a granule position) is hashed. This is the first SAMPLE_SIZE bytes of
+    # audio, and the pages at the end of the file.
+    sha = hashlib.sha1()
+    f.seek(0)
+    hashed = 0
+    while hashed<SAMPLE_SIZE:
+        page = read_ogg_page(f)
+        if page is None:
+            break
+        if page[0]!=0 and page[0]!=0xffffffffffffffff:
+            sha.update(page[1])
+            hashed += len(page[1])
+    if 0==hashed:
+        return None
+    tail_start = max(f.tell(), size-SAMPLE_SIZE)
+    f.seek(tail_start)
+    tail = f.read()
+    pos = tail.find(b'OggS')
+    while pos>=0:
+        # Payload may contain 'OggS', so only accept a position from which pages
+        # can be read up to the end of the file.
+        f.seek(tail_start+pos)
+        pages = []
+        page = read_ogg_page(f)
+        while page is not None:
+            pages.append(page)
+            page = read_ogg_page(f)
+        if f.tell()==size:
+            for granule, payload in pages:
+                sha.update(granule.to_bytes(8, 'little'))
+                sha.update(payload)
+            break
+        pos = tail.find(b'OggS', pos+1)
+    return sha.hexdigest()
+
+
+def get_range_hash(f, start, end):
+    sha = hashlib.sha1()
+    length = end-start
+    sha.update(length.to_bytes(8, 'little'))
+    if length<=SAMPLE_SIZE*3:
+        offsets = [start]
+        sample_size = length
+    else:
+        offsets = [start, start+(length-SAMPLE_SIZE)//2, end-SAMPLE_SIZE]
+        sample_size = SAMPLE_SIZE
+    for offset in offsets:
+        f.seek(offset)
+        sha.update(f.read(sample_size))
+    return sha.hexdigest()
+
+
+@metrics.timed('content_hash')
+def get_hash(path):
+    # Hash of the audio data of a file, or None if format is not known
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            header = f.read(12)
+            if header[:4]==b'OggS':
+                return get_ogg_hash(f, size)
+            if header[:4]==b'fLaC':
+                audio = get_flac_range(f, size)
+            elif header[4:8]==b'ftyp':
+                audio = get_mp4_range(f, size)
+            elif header[:3]==b'ID3' or (len(header)>=2 and header[0]==0xff and (header[1]&0xe0)==0xe0):
+                audio = get_id3_range(f, size)
+            else:
+                return None
+            if audio is None or audio[1]<=audio[0]:
+                return None
+            return get_range_hash(f, audio[0], audio[1])
+    except OSError as e:
+        _LOGGER.debug('Failed to hash %s - %s' % (path, str(e)))
+    return None
+
+
+def filter_files(db, files, config):
+    # Tracks with the same audio as one in the DB are given its results (as
+    # 'values'), and so are not analysed again. CUE tracks are not checked.
+    hashes = db.get_file_hashes()
+    moved = 0
+    copied = 0
+    for f in files:
+        if not 'track' in f:
+            f['hash'] = get_hash(f['abs'])
+            existing = hashes.get(f['hash']) if f['hash'] is not None else None
+            values = db.get_values(existing) if existing is not None else None
+            if values is not None:
+                if existing!=f['db'] and not os.path.exists(config['essentia']+existing):
+                    _LOGGER.debug('%s moved to %s' % (existing, f['db']))
+                    db.rename_files(existing, f['db'], False)
+                    hashes[f['hash']] = f['db']
+                    moved += 1
+                else:
+                    _LOGGER.debug('%s has same audio as %s' % (f['db'], existing))
+                    copied += 1
+                f['values'] = values
+                metrics.count('tracks_deduplicated')
+            elif f['hash'] is not None:
+                # Later copies (in this run) use this track's results, if stored by then
+                hashes[f['hash']] = f['db']
+        yield f
+    if moved>0 or copied>0:
+        _LOGGER.info('Found %d moved tracks, and %d with audio already analysed' % (moved, copied))
@@ -0,0 +1,90 @@
+#
+# Analyse files with Essentia
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import logging
+import os
+import pathlib
+import subprocess
+import threading
+from . import cache, metrics
+
+_LOGGER = logging.getLogger(__name__)
+ROOT = pathlib.Path(__file__).parent.parent.absolute()
+PROFILE = 'profile'
+_local = threading.local()
+
+
+def get_models():
+    # Absolute paths of SVM models listed in profile
+    models = []
+    with open(os.path.join(ROOT, PROFILE), 'r') as f:
+        for line in f:
+            line = line.strip().strip(',').strip("'").strip('"')
+            if line.endswith('.history'):
+                models.append(os.path.join(ROOT, line))
+    return models
+
+
+class ProcessExtractor(object):
+    # Runs the extractor binary for each track. This reloads the models each time.
+    def __init__(self, config):
+        self.binary = config['extractor']
+
+
+    def analyse(self, path, jsfile):
+        with metrics.timer('extractor'):
+            subprocess.call([self.binary, path, jsfile, PROFILE], shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=ROOT)
+        if not os.path.exists(jsfile):
+            _LOGGER.error('No JSON created for %s' % path)
+            return None
+        try:
+            with metrics.timer('json_parse'), open(jsfile, 'rb') as js:
+                return cache.read_values(js)
+        except (ValueError, KeyError):
+            _LOGGER.error('Failed to parse %s for %s' % (jsfile, path))
+        return None
+
+
+class EssentiaExtractor(object):
+    # Uses Essentia's python module, so models are only loaded once - per thread,
+    # or per process if 'processes' is set. The extractor's JSON output is only
+    # written if needed for the 'files' JSON cache.
+    def __init__(self, config):
+        import essentia
+        import essentia.standard
+        essentia.log.infoActive = False
+        essentia.log.warningActive = False
+        self.standard = essentia.standard
+        self.write_json = 'json_cache' in config and 'files'==config['json_cache_format']
+        self.extractor = essentia.standard.MusicExtractor(highlevel=get_models())
+
+
+    def analyse(self, path, jsfile):
+        try:
+            with metrics.timer('extractor'):
+                features, frames = self.extractor(path)
+        except RuntimeError as e:
+            _LOGGER.error('Failed to analyse %s - %s' % (path, str(e)))
+            return None
+        if self.write_json:
+            self.standard.YamlOutput(filename=jsfile, format='json')(features)
+        try:
+            values = {}
+            for name, model, cls in cache.HIGHLEVEL_VALUES:
+                values[name] = float(features['highlevel.%s.all.%s' % (model, cls)])
+            values['bpm'] = int(features['rhythm.bpm'])
+            return values
+        except KeyError as e:
+            _LOGGER.error('Missing %s in results for %s' % (str(e), path))
+        return None
+
+
+def get_extractor(config):
+    # Extractor for the current thread
+    if not hasattr(_local, 'extractor'):
+        _local.extractor = EssentiaExtractor(config) if 'essentia'==config['extractor_backend'] else ProcessExtractor(config)
+    return _local.extractor
@@ -0,0 +1,156 @@
+#
+# Analyse files with Essentia
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+# Packed, normalised, feature matrix of all tracks - for nearest neighbour
+# queries. Stored as <base>.npy (float32, one row per track), <base>.json
+# (paths, and normalisation values), and optionally <base>-index.npz (k-means
+# partitions). Requires numpy.
+
+import json
+import logging
+import os
+import sqlite3
+import time
+from urllib.parse import quote
+
+_LOGGER = logging.getLogger(__name__)
+FEATURES = ['danceable', 'aggressive', 'electronic', 'acoustic', 'happy', 'party', 'relaxed', 'sad', 'dark', 'tonal', 'voice', 'bpm']
+BATCH_SIZE = 65536
+KMEANS_ITERATIONS = 10
+
+
+def save_atomic(path, save):
+    # Write to temporary file and rename, so readers never see a partial file
+    tmp = '%s.tmp-%d' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        save(f)
+    os.replace(tmp, path)
+
+
+def kmeans(matrix, num_partitions):
+    import numpy as np
+    rng = np.random.default_rng(0)
+    centroids = matrix[rng.choice(len(matrix), num_partitions, replace=False)].copy()
+    for i in range(KMEANS_ITERATIONS):
+        assign = nearest_centroids(matrix, centroids, 1)[:, 0]
+        for c in range(num_partitions):
+            members = matrix[assign==c]
+            if len(members)>0:
+                centroids[c] = members.mean(axis=0)
+    return centroids, nearest_centroids(matrix, centroids, 1)[:, 0]
+
+
+def nearest_centroids(matrix, centroids, n):
+    import numpy as np
+    result = np.empty((len(matrix), n), dtype=np.int32)
+    for start in range(0, len(matrix), BATCH_SIZE):
+        batch = matrix[start:start+BATCH_SIZE]
+        dist = (batch*batch).sum(axis=1)[:, None] - 2*batch@centroids.T + (centroids*centroids).sum(axis=1)[None, :]
+        result[start:start+len(batch)] = np.argsort(dist, axis=1)[:, :n]
+    return result
+
+
+def export_features(db_file, base, num_partitions=0):
+    import numpy as np
+    start = time.monotonic()
+    conn = sqlite3.connect('file:%s?mode=ro' % quote(db_file), uri=True)
+    try:
+        rows = conn.execute('SELECT file, ignore, %s FROM tracks ORDER BY file' % ', '.join(FEATURES)).fetchall()
+    finally:
+        conn.close()
+    if len(rows)==0:
+        _LOGGER.info('No tracks, not exporting features')
+        return False
+
+    matrix = np.array([row[2:] for row in rows], dtype=np.float32)
+    mean = matrix.mean(axis=0)
+    std = matrix.std(axis=0)
+    std[std==0] = 1.0
+    matrix = (matrix-mean)/std
+    meta = {'features':FEATURES, 'mean':mean.tolist(), 'std':std.tolist(), 'files':[row[0] for row in rows], 'ignore':[i for i, row in enumerate(rows) if row[1]==1]}
+
+    save_atomic(base+'.npy', lambda f: np.save(f, matrix))
+    save_atomic(base+'.json', lambda f: f.write(json.dumps(meta).encode()))
+    if num_partitions>0 and len(rows)>num_partitions:
+        centroids, assign = kmeans(matrix, num_partitions)
+        order = np.argsort(assign, kind='stable').astype(np.int32)
+        offsets = np.searchsorted(assign[order], np.arange(num_partitions+1)).astype(np.int64)
+        save_atomic(base+'-index.npz', lambda f: np.savez(f, centroids=centroids, order=order, offsets=offsets))
+    elif os.path.exists(base+'-index.npz'):
+        os.remove(base+'-index.npz')
+    _LOGGER.info('Exported features of %d tracks in %.2f seconds' % (len(rows), time.monotonic()-start))
+    return True
+
+
+class FeatureIndex(object):
+    # Nearest neighbour queries on exported features. The matrix is memory-mapped.
+    def __init__(self, base):
+        import numpy as np
+        self.np = np
+        self.matrix = np.load(base+'.npy', mmap_mode='r')
+        with open(base+'.json', 'r') as f:
+            meta = json.load(f)
+        self.files = meta['files']
+        self.rows = {path:i for i, path in enumerate(self.files)}
+        self.ignore = np.zeros(len(self.files), dtype=bool)
+        self.ignore[meta['ignore']] = True
+        self.mean = np.array(meta['mean'], dtype=np.float32)
+        self.std = np.array(meta['std'], dtype=np.float32)
+        self.centroids = None
+        if os.path.exists(base+'-index.npz'):
+            index = np.load(base+'-index.npz')
+            self.centroids = index['centroids']
+            self.order = index['order']
+            self.offsets = index['offsets']
+
+
+    def normalise(self, values):
+        # values is a dict of feature values, as stored in tracks table
+        return (self.np.array([values[f] for f in FEATURES], dtype=self.np.float32)-self.mean)/self.std
+
+
+    def query(self, path, k=50, nprobe=0, skip_ignored=True):
+        # Returns list of (path, distance) of the k nearest tracks to path
+        if not path in self.rows:
+            return []
+        row = self.rows[path]
+        return self.query_vector(self.matrix[row], k, nprobe, skip_ignored, exclude=row)
+
+
+    def query_vector(self, vector, k=50, nprobe=0, skip_ignored=True, exclude=None):
+        # If nprobe>0, and an index was exported, then only the nprobe nearest
+        # partitions are searched.
+        np = self.np
+        if nprobe>0 and self.centroids is not None:
+            parts = nearest_centroids(vector[None, :], self.centroids, min(nprobe, len(self.centroids)))[0]
+            candidates = np.concatenate([self.order[self.offsets[p]:self.offsets[p+1]] for p in parts])
+        else:
+            candidates = None
+
+        best_rows = np.empty(0, dtype=np.int64)
+        best_dist = np.empty(0, dtype=np.float32)
+        total = len(self.matrix) if candidates is None else len(candidates)
+        for start in range(0, total, BATCH_SIZE):
+            rows = np.arange(start, min(start+BATCH_SIZE, total)) if candidates is None else np.sort(candidates[start:start+BATCH_SIZE])
+            batch = self.matrix[start:start+len(rows)] if candidates is None else self.matrix[rows]
+            diff = batch-vector
+            dist = np.einsum('ij,ij->i', diff, diff)
+            if skip_ignored:
+                dist[self.ignore[rows]] = np.inf
+            if exclude is not None:
+                dist[rows==exclude] = np.inf
+            rows = np.concatenate([best_rows, rows])
+            dist = np.concatenate([best_dist, dist])
+            if len(dist)>k:
+                keep = np.argpartition(dist, k)[:k]
+                rows = rows[keep]
+                dist = dist[keep]
+            best_rows = rows
+            best_dist = dist
+
+        order = np.argsort(best_dist)
+        return [(self.files[best_rows[i]], float(np.sqrt(best_dist[i]))) for i in order if np.isfinite(best_dist[i])]
@@ -0,0 +1,86 @@
+#
+# Analyse files with Essentia
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+# Rules used to set the 'ignore' column. Each line of an ignore file is one of:
+#   <path prefix>    e.g. 'AC-DC/Power Up/', matched case-insensitively
+#   glob:<pattern>   e.g. 'glob:*/Christmas*', matched against whole path
+#   genre:<genre>    e.g. 'genre:Comedy', matched case-insensitively
+# Blank lines, and those starting with '#', are skipped.
+
+import bisect
+import fnmatch
+import time
+from . import tracks_db
+
+
+class IgnoreRules(object):
+    def __init__(self, lines):
+        prefixes = set()
+        self.globs = []
+        self.genres = set()
+        for line in lines:
+            val = line.strip()
+            if len(val)==0 or val.startswith('#'):
+                continue
+            if val.startswith('glob:'):
+                self.globs.append(val[5:])
+            elif val.startswith('genre:'):
+                self.genres.add(val[6:].strip().lower())
+            else:
+                prefixes.add(val.lower())
+        # Prefixes that start with another prefix are not needed. Once removed,
+        # the only prefix that can match a path is the last one that sorts
+        # before (or equal to) it.
+        self.prefixes = []
+        for prefix in sorted(prefixes):
+            if len(self.prefixes)==0 or not prefix.startswith(self.prefixes[-1]):
+                self.prefixes.append(prefix)
+
+
+    def matches_prefix(self, path):
+        path = path.lower()
+        idx = bisect.bisect_right(self.prefixes, path)
+        return idx>0 and path.startswith(self.prefixes[idx-1])
+
+
+    def matches(self, path, genre):
+        if self.matches_prefix(path):
+            return True
+        if len(self.genres)>0 and genre is not None:
+            for g in genre.split(tracks_db.GENRE_SEPARATOR):
+                if g.strip().lower() in self.genres:
+                    return True
+        for pattern in self.globs:
+            if fnmatch.fnmatchcase(path, pattern):
+                return True
+        return False
+
+
+def update_ignore(cursor, rules):
+    # Single scan of tracks, then only rows whose ignore value changes are
+    # written - in one transaction. Returns (number ignored, number changed,
+    # time taken). Compact DBs are updated directly, rather than via the
+    # 'tracks' view's triggers.
+    start = time.monotonic()
+    table = 'track_meta' if tracks_db.is_compact(cursor) else 'tracks'
+    cursor.execute('SELECT file, genre, ignore FROM %s' % table)
+    ignored = 0
+    changes = []
+    for path, genre, current in cursor.fetchall():
+        ignore = 1 if rules.matches(path, genre) else 0
+        ignored += ignore
+        if current!=ignore:
+            changes.append((ignore, path))
+    if len(changes)>0:
+        cursor.execute('BEGIN')
+        try:
+            cursor.executemany('UPDATE %s SET ignore=? WHERE file=?' % table, changes)
+            cursor.execute('COMMIT')
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+    return (ignored, len(changes), time.monotonic()-start)
@@ -0,0 +1,61 @@
+#
+# Analyse files with Essentia
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+# Job journal. The state of each track's analysis (queued, running, done, or
+# failed), number of attempts, and reason for failure, is stored in the DB's
+# 'jobs' table. Results are also written to a file (named from a hash of the
+# track's path) as soon as each analysis completes, and only removed once the
+# results are in the DB - so after a crash these are used rather than analysing
+# the track again.
+
+import hashlib
+import json
+import logging
+import os
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def get_folder(config):
+    return config['db']+'-jobs'
+
+
+def get_file(config, db_path):
+    return os.path.join(get_folder(config), '%s.json' % hashlib.sha1(db_path.encode()).hexdigest())
+
+
+def read_values(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_values(path, values):
+    # Written to temporary file and renamed, so a crash never leaves partial file
+    tmp = '%s.tmp' % path
+    with open(tmp, 'w') as f:
+        json.dump(values, f)
+    os.replace(tmp, path)
+
+
+def filter_files(db, files, config):
+    # Skip tracks that have failed (or were being analysed when the analyzer
+    # crashed) 'max_retries' times - unless the file has changed since.
+    attempts = db.get_job_attempts()
+    skipped = 0
+    for f in files:
+        prev = attempts.get(f['db'])
+        if prev is not None and prev[0]>=config['max_retries'] and prev[1]==f['state'][1] and prev[2]==f['state'][2]:
+            _LOGGER.debug('Skipping %s, failed %d times' % (f['db'], prev[0]))
+            skipped += 1
+            continue
+        db.queue_job(f['db'])
+        yield f
+    if skipped>0:
+        _LOGGER.info('Skipped %d tracks that have failed %d times' % (skipped, config['max_retries']))
@@ -0,0 +1,242 @@
+#
+# Analyse files with Essentia
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+# Timings of each stage of analysis (as histograms), counters, and queue depths.
+# A summary is logged periodically, and the metrics may be written to a JSON
+# file at the end of a run, and served (in Prometheus' text format) whilst it
+# runs.
+
+import contextlib
+import functools
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_LOGGER = logging.getLogger(__name__)
+BUCKETS = [0.001, 0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300]
+_local = threading.local()
+
+
+class Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        # Count of values <= each bucket, plus those above the last bucket
+        self.buckets = [0]*(len(BUCKETS)+1)
+
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        for i, bucket in enumerate(BUCKETS):
+            if value<=bucket:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+
+    def to_dict(self):
+        return {'count':self.count, 'sum':self.sum, 'avg':self.sum/self.count if self.count>0 else None, 'min':self.min, 'max':self.max,
+                'buckets':{str(bucket):count for bucket, count in zip(BUCKETS+['+Inf'], self.buckets)}}
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        with self.lock:
+            self.start = time.monotonic()
+            self.counters = {}
+            self.stages = {}
+            self.gauges = {}
+            self.last_report = self.start
+            self.total = None
+
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0)+value
+
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if not stage in self.stages:
+                self.stages[stage] = Histogram()
+            self.stages[stage].observe(seconds)
+
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+
+    def to_dict(self):
+        with self.lock:
+            return {'elapsed':time.monotonic()-self.start, 'counters':dict(self.counters), 'gauges':dict(self.gauges),
+                    'stages':{stage:hist.to_dict() for stage, hist in self.stages.items()}}
+
+
+    def to_prometheus(self):
+        lines = []
+        data = self.to_dict()
+        lines.append('essentia_analyzer_elapsed_seconds %f' % data['elapsed'])
+        for name, value in sorted(data['counters'].items()):
+            lines.append('essentia_analyzer_%s_total %d' % (name, value))
+        for name, value in sorted(data['gauges'].items()):
+            lines.append('essentia_analyzer_queue_depth{queue="%s"} %d' % (name, value))
+        for stage, hist in sorted(data['stages'].items()):
+            cumulative = 0
+            for bucket, count in hist['buckets'].items():
+                cumulative += count
+                lines.append('essentia_analyzer_stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, bucket, cumulative))
+            lines.append('essentia_analyzer_stage_seconds_sum{stage="%s"} %f' % (stage, hist['sum']))
+            lines.append('essentia_analyzer_stage_seconds_count{stage="%s"} %d' % (stage, hist['count']))
+        return '\n'.join(lines)+'\n'
+
+
+    def summary(self):
+        # Progress is based upon tracks completed, not those submitted
+        data = self.to_dict()
+        done = data['counters'].get('tracks_done', 0)
+        rate = done/data['elapsed'] if data['elapsed']>0 else 0
+        if self.total:
+            eta = '%d:%02d:%02d' % divmod_time((self.total-done)/rate) if rate>0 else 'unknown'
+            summary = '[%d/%d %d%%] %.2f tracks/s, ETA %s' % (done, self.total, int(done*100/self.total), rate, eta)
+        else:
+            summary = '[%d] %.2f tracks/s' % (done, rate)
+        stages = ['%s:%.2fs' % (stage, hist['avg']) for stage, hist in sorted(data['stages'].items()) if hist['count']>0]
+        if len(stages)>0:
+            summary += ' (avg %s)' % ' '.join(stages)
+        queues = ['%s:%d' % (name, value) for name, value in sorted(data['gauges'].items())]
+        if len(queues)>0:
+            summary += ' (queues %s)' % ' '.join(queues)
+        return summary
+
+
+    def report_if_due(self, interval):
+        now = time.monotonic()
+        if interval>0 and (now-self.last_report)>=interval:
+            self.last_report = now
+            _LOGGER.info(self.summary())
+
+
+def divmod_time(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return (hours, minutes, seconds)
+
+
+METRICS = Metrics()
+
+
+def record(stage, seconds):
+    # If timings are being captured (see capture()) these are only added to the
+    # captured list, to be merged later - as they may be in another process.
+    captured = getattr(_local, 'captured', None)
+    if captured is not None:
+        captured.append((stage, seconds))
+    else:
+        METRICS.observe(stage, seconds)
+
+
+@contextlib.contextmanager
+def timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter()-start)
+
+
+def timed(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def capture():
+    _local.captured = []
+    try:
+        yield _local.captured
+    finally:
+        _local.captured = None
+
+
+def merge(stages):
+    for stage, seconds in stages:
+        METRICS.observe(stage, seconds)
+
+
+def count(name, value=1):
+    METRICS.count(name, value)
+
+
+def gauge(name, value):
+    METRICS.gauge(name, value)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if '/metrics'!=self.path:
+            self.send_error(404)
+            return
+        body = METRICS.to_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(config, total=None):
+    # Returns HTTP server, if 'metrics_port' is set
+    METRICS.reset()
+    METRICS.total = total
+    if not 'metrics_port' in config:
+        return None
+    try:
+        server = ThreadingHTTPServer(('127.0.0.1', config['metrics_port']), MetricsHandler)
+    except OSError as e:
+        _LOGGER.error('Failed to start metrics server - %s' % str(e))
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def set_total(total):
+    METRICS.total = total
+
+
+def finish(config, server):
+    _LOGGER.info(METRICS.summary())
+    if 'metrics_file' in config:
+        try:
+            with open(config['metrics_file'], 'w') as f:
+                json.dump(METRICS.to_dict(), f, indent=1)
+        except OSError as e:
+            _LOGGER.error('Failed to write metrics - %s' % str(e))
+    if server is not None:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,79 @@
+#
+# Analyse files with Essentia
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import logging
+import os
+import time
+
+_LOGGER = logging.getLogger(__name__)
+ADJUST_INTERVAL = 15 # Seconds between changes to the limit
+
+
+def get_available_memory():
+    # Returns available memory in MiB, or None if not known
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])/1024
+    except:
+        pass
+    return None
+
+
+class AdaptiveLimit(object):
+    # Controls how many tracks (extractor and ffmpeg calls) are processed
+    # concurrently. Shrinks the limit if free memory is low or the machine is
+    # overloaded, grows it whilst there are idle cores - and backs off a step if
+    # growing made throughput worse (i.e. tracks took longer each).
+    def __init__(self, config):
+        self.min = config['min_threads']
+        self.max = config['max_threads']
+        self.min_free_memory = config['min_free_memory']
+        self.cpus = os.cpu_count()
+        self.limit = max(self.min, min(self.max, config['threads']))
+        self.last_adjust = time.monotonic()
+        self.completed = 0
+        self.wall_time = 0.0
+        self.last_throughput = None
+        self.last_change = 0
+        _LOGGER.debug('Adaptive thread limit: %d (min:%d max:%d)' % (self.limit, self.min, self.max))
+
+
+    def job_done(self, wall_time):
+        self.completed += 1
+        self.wall_time += wall_time
+        now = time.monotonic()
+        if (now-self.last_adjust)>=ADJUST_INTERVAL:
+            self.adjust(now)
+
+
+    def adjust(self, now):
+        throughput = self.completed/(now-self.last_adjust)
+        avg_time = self.wall_time/self.completed if self.completed>0 else 0
+        load = os.getloadavg()[0]
+        free = get_available_memory()
+        change = 0
+        if free is not None and free<self.min_free_memory:
+            change = -1
+        elif load>self.cpus*1.25:
+            change = -1
+        elif self.last_change>0 and self.last_throughput is not None and throughput<self.last_throughput*0.9:
+            # Last increase did not help
+            change = -1
+        elif load<self.cpus*0.9:
+            change = 1
+
+        limit = max(self.min, min(self.max, self.limit+change))
+        if limit!=self.limit:
+            _LOGGER.debug('Thread limit %d -> %d (load:%.2f free:%s MiB tracks/s:%.2f avg:%.1fs)' % (self.limit, limit, load, 'unknown' if free is None else '%d' % free, throughput, avg_time))
+        self.last_change = limit-self.limit
+        self.limit = limit
+        self.last_throughput = throughput
+        self.last_adjust = now
+        self.completed = 0
+        self.wall_time = 0.0
@@ -7,90 +7,108 @@
 
 import json
 import logging
+from . import metrics
 
 _LOGGER = logging.getLogger(__name__)
+_PARSERS = None
+# Format to assume, if not known from file contents
+EXTENSION_FORMATS = {'m4a':'mp4', 'mp4':'mp4', 'mp3':'mp3', 'ogg':'vorbis', 'opus':'opus', 'flac':'flac'}
+# Formats to try, in order, if file is not of the expected format
+FALLBACK_ORDER = ['mp4', 'mp3', 'id3', 'vorbis', 'flac', 'oggflac', 'opus']
 
 
-def get_ogg_or_flac(path):
-    from mutagen.oggflac import OggFLAC
-    from mutagen.oggopus import OggOpus
-    from mutagen.oggvorbis import OggVorbis
-    from mutagen.flac import FLAC
+def get_parsers():
+    # Import mutagen modules once, on first use
+    global _PARSERS
+    if _PARSERS is None:
+        from mutagen.flac import FLAC
+        from mutagen.id3 import ID3
+        from mutagen.mp3 import MP3
+        from mutagen.mp4 import MP4
+        from mutagen.oggflac import OggFLAC
+        from mutagen.oggopus import OggOpus
+        from mutagen.oggvorbis import OggVorbis
+        _PARSERS = {'mp4':MP4, 'mp3':MP3, 'id3':ID3, 'vorbis':OggVorbis, 'flac':FLAC, 'oggflac':OggFLAC, 'opus':OggOpus}
+    return _PARSERS
 
-    try:
-        return OggVorbis(path)
-    except:
-        pass
-    try:
-        return FLAC(path)
-    except:
-        pass
-    try:
-        return OggFLAC(path)
-    except:
-        pass
-    try:
-        return OggOpus(path)
-    except:
-        pass
-    return None
 
+def get_format(header, path):
+    # Determine format from magic bytes, falling back to file extension
+    if header.startswith(b'fLaC'):
+        return 'flac'
+    if header.startswith(b'OggS'):
+        if header[28:35]==b'\x01vorbis':
+            return 'vorbis'
+        if header[28:36]==b'OpusHead':
+            return 'opus'
+        if header[28:33]==b'\x7fFLAC':
+            return 'oggflac'
+    if header[4:8]==b'ftyp':
+        return 'mp4'
+    if header.startswith(b'ID3') or (len(header)>1 and header[0]==0xFF and (header[1]&0xE0)==0xE0):
+        return 'mp3'
+    parts = path.rsplit('.', 1)
+    return EXTENSION_FORMATS.get(parts[1].lower()) if len(parts)>1 else None
 
-def read_tags(path, genre_separator):
-    from mutagen.id3 import ID3
-    from mutagen.mp3 import MP3
-    from mutagen.mp4 import MP4
 
-    try:
-        audio = MP4(path)
-        tags = {'title':str(audio['\xa9nam'][0]), 'artist':str(audio['\xa9ART'][0]), 'album':str(audio['\xa9alb'][0]), 'duration':int(audio.info.length), 'albumartist':None, 'genres':None}
-        if 'aART' in audio:
-            tags['albumartist']=str(audio['aART'][0])
-        if '\xa9gen' in audio:
-            tags['genres']=[]
-            for g in audio['\xa9gen']:
-                tags['genres'].append(str(g))
-        #_LOGGER.debug('MP4 File: %s Meta: %s' % (path, json.dumps(tags)))
-        return tags
-    except:
-        pass
+def get_mp4_tags(audio, genre_separator):
+    tags = {'title':str(audio['\xa9nam'][0]), 'artist':str(audio['\xa9ART'][0]), 'album':str(audio['\xa9alb'][0]), 'duration':int(audio.info.length), 'albumartist':None, 'genres':None}
+    if 'aART' in audio:
+        tags['albumartist']=str(audio['aART'][0])
+    if '\xa9gen' in audio:
+        tags['genres']=[]
+        for g in audio['\xa9gen']:
+            tags['genres'].append(str(g))
+    return tags
 
-    try:
-        audio = MP3(path)
-        tags = {'title':str(audio['TIT2']), 'artist':str(audio['TPE1']), 'album':str(audio['TALB']), 'duration':int(audio.info.length), 'albumartist':None, 'genres':None}
-        if 'TPE2' in audio:
-            tags['albumartist']=str(audio['TPE2'])
-        if 'TCON' in audio:
-            tags['genres']=str(audio['TCON']).split(genre_separator)
-        #_LOGGER.debug('MP3 File: %s Meta: %s' % (path, json.dumps(tags)))
-        return tags
-    except Exception as e:
-        #print("EX:%s" % str(e))
-        pass
 
+def get_id3_tags(audio, genre_separator):
+    # MP3 files have stream info, plain ID3 tags do not
+    duration = int(audio.info.length) if hasattr(audio, 'info') else 0
+    tags = {'title':str(audio['TIT2']), 'artist':str(audio['TPE1']), 'album':str(audio['TALB']), 'duration':duration, 'albumartist':None, 'genres':None}
+    if 'TPE2' in audio:
+        tags['albumartist']=str(audio['TPE2'])
+    if 'TCON' in audio:
+        tags['genres']=str(audio['TCON']).split(genre_separator)
+    return tags
+
+
+def get_vorbis_tags(audio, genre_separator):
+    tags = {'title':str(audio['TITLE'][0]), 'artist':str(audio['ARTIST'][0]), 'album':str(audio['ALBUM'][0]), 'duration':int(audio.info.length), 'albumartist':None, 'genres':None}
+    if 'ALBUMARTIST' in audio:
+        tags['albumartist']=str(audio['ALBUMARTIST'][0])
+    if 'GENRE' in audio:
+        tags['genres']=[]
+        for g in audio['GENRE']:
+            tags['genres'].append(str(g))
+    return tags
+
+
+TAG_READERS = {'mp4':get_mp4_tags, 'mp3':get_id3_tags, 'id3':get_id3_tags, 'vorbis':get_vorbis_tags, 'flac':get_vorbis_tags, 'oggflac':get_vorbis_tags, 'opus':get_vorbis_tags}
+
+
+@metrics.timed('tag_read')
+def read_tags(path, genre_separator):
+    parsers = get_parsers()
     try:
-        audio = ID3(path)
-        tags = {'title':str(audio['TIT2']), 'artist':str(audio['TPE1']), 'album':str(audio['TALB']), 'duration':0, 'albumartist':None, 'genres':None}
-        if 'TPE2' in audio:
-            tags['albumartist']=str(audio['TPE2'])
-        if 'TCON' in audio:
-            tags['genres']=str(audio['TCON']).split(genre_separator)
-        #_LOGGER.debug('ID3 File: %s Meta: %s' % (path, json.dumps(tags)))
-        return tags
-    except:
-        pass
-
-    audio = get_ogg_or_flac(path)
-    if audio:
-        tags = {'title':str(audio['TITLE'][0]), 'artist':str(audio['ARTIST'][0]), 'album':str(audio['ALBUM'][0]), 'duration':int(audio.info.length), 'albumartist':None, 'genres':None}
-        if 'ALBUMARTIST' in audio:
-            tags['albumartist']=str(audio['ALBUMARTIST'][0])
-        if 'GENRE' in audio:
-            tags['genres']=[]
-            for g in audio['GENRE']:
-                tags['genres'].append(str(g))
-        #_LOGGER.debug('OGG File: %s Meta: %s' % (path, json.dumps(tags)))
-        return tags
+        with open(path, 'rb') as f:
+            fmt = get_format(f.read(64), path)
+            # Try expected format first, and only if that fails try the others. For
+            # MP3s try plain ID3 next, in case no MPEG frames were found.
+            formats = [] if fmt is None else [fmt]
+            if 'mp3'==fmt:
+                formats.append('id3')
+            formats += [x for x in FALLBACK_ORDER if x not in formats]
+            for name in formats:
+                try:
+                    f.seek(0)
+                    tags = TAG_READERS[name](parsers[name](f), genre_separator)
+                    #_LOGGER.debug('%s File: %s Meta: %s' % (name, path, json.dumps(tags)))
+                    return tags
+                except:
+                    pass
+    except OSError as e:
+        _LOGGER.debug('Failed to read %s - %s' % (path, str(e)))
 
     _LOGGER.debug('File:%s Meta:NONE' % path)
     return None
@@ -9,16 +9,154 @@ import json
 import logging
 import os
 import sqlite3
-from . import cue, tags
+import time
+from . import cue, metrics
 
 GENRE_SEPARATOR = ';'
 _LOGGER = logging.getLogger(__name__)
+META_COLUMNS = ['file', 'title', 'artist', 'album', 'albumartist', 'genre', 'duration']
+SCORE_COLUMNS = ['danceable', 'aggressive', 'electronic', 'acoustic', 'happy', 'party', 'relaxed', 'sad', 'dark', 'tonal', 'voice']
+# Compact DBs store scores (0..1) as integers 0..SCORE_SCALE
+SCORE_SCALE = 255
+QUEUE_JOBS_SQL = "INSERT INTO jobs (file, state, attempts) VALUES (?, 'queued', 0) ON CONFLICT(file) DO UPDATE SET state='queued'"
+
+def get_meta(tags):
+    genre = None
+    if 'genres' in tags and tags['genres'] is not None:
+        genre = GENRE_SEPARATOR.join(tags['genres'])
+
+    albumartist = None
+    if 'albumartist' in tags and tags['albumartist'] is not None:
+        albumartist = tags['albumartist']
+
+    return (tags['title'], tags['artist'], tags['album'], albumartist, genre, tags['duration'])
+
+
+def get_row(track):
+    return (track['path'],) + get_meta(track['tags']) + (track['danceable'], track['aggressive'], track['electronic'], track['acoustic'], track['happy'], track['party'], track['relaxed'], track['sad'], track['dark'], track['tonal'], track['voice'], track['bpm'])
+
+
+def quantise(score):
+    return max(0, min(SCORE_SCALE, int(round(score*SCORE_SCALE))))
+
+
+def sql_quantise(expr):
+    return 'max(0, min(%d, cast(round((%s)*%d) as integer)))' % (SCORE_SCALE, expr, SCORE_SCALE)
+
+
+def is_compact(cursor):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='track_meta'")
+    return cursor.fetchone() is not None
+
+
+def make_compact(cursor):
+    # Store metadata and scores in separate tables, keyed on an integer id, with
+    # scores quantised to small integers. Rows of an existing 'tracks' table are
+    # moved across, and 'tracks' is replaced by a view (with triggers) of the
+    # same columns - so that existing queries, and updates, still work.
+    start = time.monotonic()
+    cursor.execute("SELECT type FROM sqlite_master WHERE name='tracks'")
+    row = cursor.fetchone()
+    migrate = row is not None and 'table'==row[0]
+    if migrate:
+        try:
+            cursor.execute('ALTER TABLE tracks ADD COLUMN title varchar default null')
+        except:
+            pass
+    meta = ', '.join(META_COLUMNS)
+    scores = ', '.join(SCORE_COLUMNS)
+    cursor.execute('BEGIN')
+    try:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS track_meta (
+                    id integer PRIMARY KEY,
+                    file varchar UNIQUE NOT NULL,
+                    title varchar,
+                    artist varchar,
+                    album varchar,
+                    albumartist varchar,
+                    genre varchar,
+                    duration integer,
+                    ignore integer default 0)''')
+        cursor.execute('CREATE TABLE IF NOT EXISTS track_scores (id integer PRIMARY KEY, %s, bpm integer)' % ', '.join(['%s integer' % c for c in SCORE_COLUMNS]))
+        if migrate:
+            cursor.execute('INSERT INTO track_meta (%s, ignore) SELECT %s, ifnull(ignore, 0) FROM tracks ORDER BY file' % (meta, meta))
+            cursor.execute('INSERT INTO track_scores (id, %s, bpm) SELECT m.id, %s, t.bpm FROM tracks t JOIN track_meta m ON m.file=t.file' % (scores, ', '.join([sql_quantise('t.'+c) for c in SCORE_COLUMNS])))
+            cursor.execute('DROP TABLE tracks')
+        cursor.execute('CREATE VIEW IF NOT EXISTS tracks AS SELECT %s, m.ignore AS ignore, %s, s.bpm AS bpm FROM track_meta m JOIN track_scores s ON s.id=m.id' % (', '.join(['m.%s AS %s' % (c, c) for c in META_COLUMNS]), ', '.join(['s.%s/%d.0 AS %s' % (c, SCORE_SCALE, c) for c in SCORE_COLUMNS])))
+        cursor.execute('CREATE TRIGGER IF NOT EXISTS track_meta_delete AFTER DELETE ON track_meta BEGIN DELETE FROM track_scores WHERE id=old.id; END')
+        cursor.execute('CREATE TRIGGER IF NOT EXISTS tracks_delete INSTEAD OF DELETE ON tracks BEGIN DELETE FROM track_meta WHERE file=old.file; END')
+        cursor.execute('CREATE TRIGGER IF NOT EXISTS tracks_insert INSTEAD OF INSERT ON tracks BEGIN INSERT INTO track_meta (%s, ignore) VALUES (%s, ifnull(new.ignore, 0)); INSERT INTO track_scores (id, %s, bpm) VALUES (last_insert_rowid(), %s, new.bpm); END' % (meta, ', '.join(['new.'+c for c in META_COLUMNS]), scores, ', '.join([sql_quantise('new.'+c) for c in SCORE_COLUMNS])))
+        cursor.execute('CREATE TRIGGER IF NOT EXISTS tracks_update INSTEAD OF UPDATE ON tracks BEGIN UPDATE track_meta SET %s, ignore=new.ignore WHERE file=old.file; UPDATE track_scores SET %s, bpm=new.bpm WHERE id=(SELECT id FROM track_meta WHERE file=new.file); END' % (', '.join(['%s=new.%s' % (c, c) for c in META_COLUMNS]), ', '.join(['%s=%s' % (c, sql_quantise('new.'+c)) for c in SCORE_COLUMNS])))
+        cursor.execute('COMMIT')
+    except:
+        cursor.execute('ROLLBACK')
+        raise
+    if migrate:
+        # Reclaim space used by old table
+        cursor.execute('VACUUM')
+        _LOGGER.info('Converted DB to compact format in %.2f seconds' % (time.monotonic()-start))
+
 
 class TracksDb(object):
     def __init__(self, config):
         _LOGGER.debug('DB: %s' % config['db'])
-        self.conn = sqlite3.connect(config['db'])
+        # Transactions are started explicitly, when buffered rows are flushed
+        self.conn = sqlite3.connect(config['db'], isolation_level=None)
         self.cursor = self.conn.cursor()
+        self.cursor.execute('PRAGMA journal_mode=WAL')
+        self.cursor.execute('PRAGMA synchronous=NORMAL')
+        self.cursor.execute('PRAGMA cache_size=-%d' % config['db_cache_size'])
+        self.cursor.execute('PRAGMA temp_store=MEMORY')
+        self.batch_size = config['db_batch_size']
+        self.batch_interval = config['db_batch_interval']
+        self.pending_add = []
+        self.pending_update = []
+        self.pending_state = []
+        self.pending_queued = []
+        self.pending_jobs = []
+        self.pending_hashes = []
+        self.last_flush = time.monotonic()
+        self.compact = is_compact(self.cursor)
+        if config['compact_db'] and not self.compact:
+            make_compact(self.cursor)
+            self.compact = True
+        # Table to use when only file, or metadata, columns are required
+        self.meta_table = 'track_meta' if self.compact else 'tracks'
+        if not self.compact:
+            self.create_tracks_table()
+        # Size, modification time, and inode of each source file when it was last
+        # analysed, and when its metadata was last read.
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS file_state (
+                    file varchar PRIMARY KEY NOT NULL,
+                    size integer,
+                    mtime integer,
+                    inode integer,
+                    meta_size integer,
+                    meta_mtime integer,
+                    meta_inode integer)''')
+        # Hash of audio data, see dedup.py
+        try:
+            self.cursor.execute('ALTER TABLE file_state ADD COLUMN hash varchar default null')
+        except:
+            pass
+        if config['dedup']:
+            self.cursor.execute('CREATE INDEX IF NOT EXISTS file_state_hash_idx ON file_state(hash)')
+        if config['journal']:
+            # Size and modification time are those of the file when last attempted
+            self.cursor.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                        file varchar PRIMARY KEY NOT NULL,
+                        state varchar,
+                        attempts integer,
+                        reason varchar,
+                        size integer,
+                        mtime integer)''')
+        # Tables (other than tracks) keyed on file, that are renamed and removed
+        # along with tracks. 'jobs' may exist from a previous run with journal.
+        self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='jobs'")
+        self.file_tables = ['file_state'] if self.cursor.fetchone() is None else ['file_state', 'jobs']
+
+
+    def create_tracks_table(self):
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS tracks (
                     file varchar PRIMARY KEY NOT NULL,
                     title varchar,
@@ -49,65 +187,343 @@ class TracksDb(object):
 
 
     def commit(self):
-        self.conn.commit()
+        self.flush()
 
 
     def close(self):
+        self.flush()
         self.cursor.close()
         self.conn.close()
 
 
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if len(self.pending_add)==0 and len(self.pending_update)==0 and len(self.pending_state)==0 and len(self.pending_queued)==0 and len(self.pending_jobs)==0 and len(self.pending_hashes)==0:
+            return
+        _LOGGER.debug('Writing %d new and %d updated tracks to DB' % (len(self.pending_add), len(self.pending_update)))
+        start = time.monotonic()
+        # Each flush is a single transaction, so a crash leaves either all or none of the batch
+        self.cursor.execute('BEGIN')
+        try:
+            if len(self.pending_add)>0 and self.compact:
+                self.cursor.executemany('INSERT INTO track_meta (file, title, artist, album, albumartist, genre, duration) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(file) DO UPDATE SET title=excluded.title, artist=excluded.artist, album=excluded.album, albumartist=excluded.albumartist, genre=excluded.genre, duration=excluded.duration', [row[:7] for row in self.pending_add])
+                self.cursor.executemany('INSERT INTO track_scores (id, danceable, aggressive, electronic, acoustic, happy, party, relaxed, sad, dark, tonal, voice, bpm) SELECT id, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ? FROM track_meta WHERE file=? ON CONFLICT(id) DO UPDATE SET danceable=excluded.danceable, aggressive=excluded.aggressive, electronic=excluded.electronic, acoustic=excluded.acoustic, happy=excluded.happy, party=excluded.party, relaxed=excluded.relaxed, sad=excluded.sad, dark=excluded.dark, tonal=excluded.tonal, voice=excluded.voice, bpm=excluded.bpm', [tuple(quantise(v) for v in row[7:18]) + (row[18], row[0]) for row in self.pending_add])
+            elif len(self.pending_add)>0:
+                self.cursor.executemany('INSERT INTO tracks (file, title, artist, album, albumartist, genre, duration, ignore, danceable, aggressive, electronic, acoustic, happy, party, relaxed, sad, dark, tonal, voice, bpm) VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(file) DO UPDATE SET title=excluded.title, artist=excluded.artist, album=excluded.album, albumartist=excluded.albumartist, genre=excluded.genre, duration=excluded.duration, danceable=excluded.danceable, aggressive=excluded.aggressive, electronic=excluded.electronic, acoustic=excluded.acoustic, happy=excluded.happy, party=excluded.party, relaxed=excluded.relaxed, sad=excluded.sad, dark=excluded.dark, tonal=excluded.tonal, voice=excluded.voice, bpm=excluded.bpm', self.pending_add)
+            if len(self.pending_update)>0:
+                self.cursor.executemany('UPDATE %s SET title=?, artist=?, album=?, albumartist=?, genre=?, duration=? WHERE file=?' % self.meta_table, self.pending_update)
+            analysed_states = [state for analysed, state in self.pending_state if analysed]
+            meta_states = [state for analysed, state in self.pending_state if not analysed]
+            if len(analysed_states)>0:
+                self.cursor.executemany('INSERT INTO file_state (file, size, mtime, inode, meta_size, meta_mtime, meta_inode) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(file) DO UPDATE SET size=excluded.size, mtime=excluded.mtime, inode=excluded.inode, meta_size=excluded.meta_size, meta_mtime=excluded.meta_mtime, meta_inode=excluded.meta_inode, hash=NULL', [state + state[1:] for state in analysed_states])
+            if len(meta_states)>0:
+                self.cursor.executemany('INSERT INTO file_state (file, meta_size, meta_mtime, meta_inode) VALUES (?, ?, ?, ?) ON CONFLICT(file) DO UPDATE SET meta_size=excluded.meta_size, meta_mtime=excluded.meta_mtime, meta_inode=excluded.meta_inode', meta_states)
+            if len(self.pending_hashes)>0:
+                # Must be after file states, as these clear the hash
+                self.cursor.executemany('UPDATE file_state SET hash=? WHERE file=?', self.pending_hashes)
+            if len(self.pending_queued)>0:
+                self.cursor.executemany(QUEUE_JOBS_SQL, [(path, ) for path in self.pending_queued])
+            # Jobs ending as 'queued' were not analysed (e.g. stop requested), so
+            # do not count as an attempt.
+            finished = [(state, reason, path) for path, state, reason, jsfile in self.pending_jobs if 'queued'!=state]
+            interrupted = [(path, ) for path, state, reason, jsfile in self.pending_jobs if 'queued'==state]
+            if len(finished)>0:
+                self.cursor.executemany('UPDATE jobs SET state=?, reason=? WHERE file=?', finished)
+            if len(interrupted)>0:
+                self.cursor.executemany("UPDATE jobs SET state='queued', attempts=max(0, attempts-1) WHERE file=?", interrupted)
+            self.cursor.execute('COMMIT')
+        except:
+            # Buffered rows are kept, so are written by a later flush (if the
+            # caller carries on)
+            self.cursor.execute('ROLLBACK')
+            raise
+        finally:
+            metrics.record('db_write', time.monotonic()-start)
+        # Results are now in DB, so journal files are no longer required
+        for path, state, reason, jsfile in self.pending_jobs:
+            if jsfile is not None and os.path.exists(jsfile):
+                os.remove(jsfile)
+        self.pending_add = []
+        self.pending_update = []
+        self.pending_state = []
+        self.pending_queued = []
+        self.pending_jobs = []
+        self.pending_hashes = []
+
+
+    def flush_if_due(self):
+        if len(self.pending_add)+len(self.pending_update)+len(self.pending_state)+len(self.pending_queued)+len(self.pending_jobs)+len(self.pending_hashes)>=self.batch_size or (time.monotonic()-self.last_flush)>=self.batch_interval:
+            self.flush()
+
+
     def add(self, track):
-        genre = None
-        if 'genres' in track['tags'] and track['tags']['genres'] is not None:
-            genre = GENRE_SEPARATOR.join(track['tags']['genres'])
+        self.add_row(get_row(track))
 
-        albumartist = None
-        if 'albumartist' in track['tags'] and track['tags']['albumartist'] is not None:
-            albumartist = track['tags']['albumartist']
 
-        self.cursor.execute('INSERT INTO tracks (file, title, artist, album, albumartist, genre, duration, ignore, danceable, aggressive, electronic, acoustic, happy, party, relaxed, sad, dark, tonal, voice, bpm) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (track['path'], track['tags']['title'], track['tags']['artist'], track['tags']['album'], albumartist, genre, track['tags']['duration'], 0, track['danceable'], track['aggressive'], track['electronic'], track['acoustic'], track['happy'], track['party'], track['relaxed'], track['sad'], track['dark'], track['tonal'], track['voice'], track['bpm']))
+    def add_row(self, row):
+        # row as returned by get_row()
+        self.pending_add.append(row)
+        self.flush_if_due()
 
 
     def update(self, track):
-        genre = None
-        if 'genres' in track['tags'] and track['tags']['genres'] is not None:
-            genre = GENRE_SEPARATOR.join(track['tags']['genres'])
+        self.update_row(get_meta(track['tags']) + (track['path'],))
+
+
+    def update_row(self, row):
+        # row is get_meta() plus path
+        self.pending_update.append(row)
+        self.flush_if_due()
+
+
+    def set_file_state(self, state, analysed):
+        # state is (file, size, mtime, inode), as returned by file_state()
+        self.pending_state.append((analysed, state))
+        self.flush_if_due()
+
+
+    def set_file_hash(self, path, content_hash):
+        # Must be called after set_file_state()
+        self.pending_hashes.append((content_hash, path))
+        self.flush_if_due()
+
+
+    def get_file_hashes(self):
+        self.cursor.execute('SELECT hash, file FROM file_state WHERE hash IS NOT NULL')
+        return {row[0]:row[1] for row in self.cursor.fetchall()}
+
 
-        albumartist = None
-        if 'albumartist' in track['tags'] and track['tags']['albumartist'] is not None:
-            albumartist = track['tags']['albumartist']
+    def get_track_meta(self, path):
+        # Stored metadata of a track, as returned by get_meta()
+        self.cursor.execute('SELECT %s FROM %s WHERE file=?' % (', '.join(META_COLUMNS[1:]), self.meta_table), (path,))
+        row = self.cursor.fetchone()
+        return None if row is None else tuple(row)
 
-        self.cursor.execute('UPDATE tracks SET title=?, artist=?, album=?, albumartist=?, genre=?, duration=? WHERE file=?', (track['tags']['title'], track['tags']['artist'], track['tags']['album'], albumartist, genre, track['tags']['duration'], track['path']))
 
+    def get_values(self, path):
+        # Analysis results of a track, as returned by cache.get_values()
+        self.cursor.execute('SELECT %s, bpm FROM tracks WHERE file=?' % ', '.join(SCORE_COLUMNS), (path,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip(SCORE_COLUMNS+['bpm'], row))
 
-    def remove_old_tracks(self, source_path):
-        non_existant_files = []
+
+    def queue_job(self, path):
+        self.pending_queued.append(path)
+        self.flush_if_due()
+
+
+    def start_job(self, path, state):
+        # Written straight away, so that attempts are counted even if the
+        # analyzer crashes - but without writing other buffered rows. Queued
+        # jobs are written first, as they would otherwise reset this job's
+        # state. state is as returned by file_state()
+        if len(self.pending_queued)>0:
+            self.cursor.execute('BEGIN')
+            try:
+                self.cursor.executemany(QUEUE_JOBS_SQL, [(path, ) for path in self.pending_queued])
+                self.cursor.execute('COMMIT')
+            except:
+                self.cursor.execute('ROLLBACK')
+                raise
+            self.pending_queued = []
+        self.cursor.execute("INSERT INTO jobs (file, state, attempts, size, mtime) VALUES (?, 'running', 1, ?, ?) ON CONFLICT(file) DO UPDATE SET state='running', attempts=CASE WHEN size=excluded.size AND mtime=excluded.mtime THEN attempts+1 ELSE 1 END, reason=NULL, size=excluded.size, mtime=excluded.mtime", (path, state[1], state[2]))
+
+
+    def end_job(self, path, state, reason=None, jsfile=None):
+        # state is 'done', 'failed', or 'queued' (if not analysed). jsfile is
+        # removed once written.
+        self.pending_jobs.append((path, state, reason, jsfile))
+        self.flush_if_due()
+
+
+    def get_job_attempts(self):
+        # Jobs 'running' at start were running when the analyzer crashed
+        self.cursor.execute("SELECT file, attempts, size, mtime FROM jobs WHERE state IN ('running', 'failed')")
+        return {row[0]:row[1:] for row in self.cursor.fetchall()}
+
+
+    def remove_old_tracks(self, existing_files):
+        # existing_files is the set of (relative) music files found on disk
         _LOGGER.debug('Looking for old tracks to remove')
+        start = time.monotonic()
         try:
-            self.cursor.execute('SELECT file FROM tracks')
-            rows = self.cursor.fetchall()
-            for row in rows:
-                if not os.path.exists(os.path.join(source_path, cue.convert_to_source(row[0]))):
-                    _LOGGER.debug("'%s' no longer exists" % row[0])
-                    non_existant_files.append(row[0])
-
-            _LOGGER.debug('Num old tracks: %d' % len(non_existant_files))
-            if len(non_existant_files)>0:
+            self.flush()
+            self.cursor.execute('SELECT file FROM %s' % self.meta_table)
+            non_existant_files = [row[0] for row in self.cursor.fetchall() if cue.convert_to_source(row[0]) not in existing_files]
+            self.cursor.execute('SELECT file FROM file_state')
+            old_states = [row[0] for row in self.cursor.fetchall() if row[0] not in existing_files]
+            old_jobs = []
+            if 'jobs' in self.file_tables:
+                self.cursor.execute('SELECT file FROM jobs')
+                old_jobs = [row[0] for row in self.cursor.fetchall() if cue.convert_to_source(row[0]) not in existing_files]
+
+            if len(non_existant_files)>0 or len(old_states)>0 or len(old_jobs)>0:
                 # Remove entries...
-                for path in non_existant_files:
-                    self.cursor.execute('DELETE from tracks where file=?', (path, ))
-                return True
+                self.cursor.execute('BEGIN')
+                try:
+                    self.cursor.executemany('DELETE from %s where file=?' % self.meta_table, [(path, ) for path in non_existant_files])
+                    self.cursor.executemany('DELETE from file_state where file=?', [(path, ) for path in old_states])
+                    if len(old_jobs)>0:
+                        self.cursor.executemany('DELETE from jobs where file=?', [(path, ) for path in old_jobs])
+                    self.cursor.execute('COMMIT')
+                except:
+                    self.cursor.execute('ROLLBACK')
+                    raise
+            _LOGGER.info('Removed %d old tracks in %.2f seconds' % (len(non_existant_files), time.monotonic()-start))
+            return len(non_existant_files)
         except Exception as e:
             _LOGGER.error('Failed to remove old tracks - %s' % str(e))
             pass
-        return False
+        return 0
+
+
+    def rename_files(self, old_path, new_path, is_dir):
+        # Rename a file (and its CUE tracks), or all files in a folder, without
+        # re-analysis. Folder paths end with '/'.
+        self.flush()
+        self.cursor.execute('BEGIN')
+        try:
+            count = 0
+            for table in [self.meta_table]+self.file_tables:
+                self.cursor.execute('DELETE FROM %s WHERE file=? OR (file>=? AND file<?)' % table, get_range(new_path, is_dir))
+                self.cursor.execute('UPDATE %s SET file=?||substr(file, ?) WHERE file=? OR (file>=? AND file<?)' % table, (new_path, len(old_path)+1) + get_range(old_path, is_dir))
+                if table==self.meta_table:
+                    count = self.cursor.rowcount
+            self.cursor.execute('COMMIT')
+        except:
+            self.cursor.execute('ROLLBACK')
+            raise
+        return count
+
+
+    def remove_files(self, path, is_dir):
+        # Remove a file (and its CUE tracks), or all files in a folder
+        self.flush()
+        self.cursor.execute('BEGIN')
+        try:
+            self.cursor.execute('DELETE FROM %s WHERE file=? OR (file>=? AND file<?)' % self.meta_table, get_range(path, is_dir))
+            count = self.cursor.rowcount
+            for table in self.file_tables:
+                self.cursor.execute('DELETE FROM %s WHERE file=? OR (file>=? AND file<?)' % table, get_range(path, is_dir))
+            self.cursor.execute('COMMIT')
+        except:
+            self.cursor.execute('ROLLBACK')
+            raise
+        return count
+
+
+    def remove_tracks(self, paths):
+        self.flush()
+        self.cursor.execute('BEGIN')
+        try:
+            self.cursor.executemany('DELETE FROM %s WHERE file=?' % self.meta_table, [(path, ) for path in paths])
+            if 'jobs' in self.file_tables:
+                self.cursor.executemany('DELETE FROM jobs WHERE file=?', [(path, ) for path in paths])
+            self.cursor.execute('COMMIT')
+        except:
+            self.cursor.execute('ROLLBACK')
+            raise
+
+
+    def get_source_tracks(self, path):
+        # Tracks stored for a file - either the file itself, or its CUE tracks
+        self.flush()
+        self.cursor.execute('SELECT file FROM %s WHERE file=? OR (file>=? AND file<?)' % self.meta_table, get_range(path, False))
+        return set(row[0] for row in self.cursor.fetchall())
+
+
+    def get_analysed_files(self, folder=None):
+        if folder is None:
+            self.cursor.execute('SELECT file FROM %s' % self.meta_table)
+            return set(row[0] for row in self.cursor.fetchall())
+        where, params = get_folder_query(folder)
+        self.cursor.execute('SELECT file FROM %s WHERE %s' % (self.meta_table, where), params)
+        return set(row[0] for row in self.cursor.fetchall())
+
+
+    def get_file_states(self, folder=None):
+        if folder is None:
+            self.cursor.execute('SELECT file, size, mtime, inode, meta_size, meta_mtime, meta_inode FROM file_state')
+            return {row[0]:row[1:] for row in self.cursor.fetchall()}
+        where, params = get_folder_query(folder)
+        self.cursor.execute('SELECT file, size, mtime, inode, meta_size, meta_mtime, meta_inode FROM file_state WHERE %s' % where, params)
+        return {row[0]:row[1:] for row in self.cursor.fetchall()}
 
 
     def file_already_analysed(self, path):
-        self.cursor.execute('SELECT danceable FROM tracks WHERE file=?', (path,))
+        self.cursor.execute('SELECT file FROM %s WHERE file=?' % self.meta_table, (path,))
         return self.cursor.fetchone() is not None
 
 
     def get_cursor(self):
         return self.cursor
+
+
+def get_folder_query(folder):
+    # Condition, and parameters, matching only files directly within folder - so
+    # that files in sub-folders are not returned. folder is '' for the top of
+    # the music folder, otherwise it ends with '/'.
+    if ''==folder:
+        return ("instr(file, '/')=0", ())
+    # Range scan on index, '0' is the character after '/'
+    return ("file>=? AND file<? AND instr(substr(file, ?), '/')=0", (folder, folder[:-1]+'0', len(folder)+1))
+
+
+def get_range(path, is_dir):
+    # Query parameters matching path and its CUE tracks, or all files in folder
+    prefix = path if is_dir else path+cue.CUE_TRACK
+    return (path, prefix, prefix[:-1]+chr(ord(prefix[-1])+1))
+
+
+def file_state(db_path, st):
+    # st is an os.stat_result
+    return (db_path, st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+class AnalysedFiles(object):
+    # Membership test for files already in the DB, and their stored file state.
+    # Either all paths are loaded once, or (to keep memory bounded) those of one
+    # folder at a time.
+    def __init__(self, db, per_folder, check_inode):
+        self.db = db
+        self.per_folder = per_folder
+        self.check_inode = check_inode
+        self.folder = None
+        self.files = set() if per_folder else db.get_analysed_files()
+        self.states = {} if per_folder else db.get_file_states()
+        if not per_folder:
+            _LOGGER.debug('Loaded %d analysed files' % len(self.files))
+
+
+    def load_folder(self, path):
+        if self.per_folder:
+            folder = path[:path.rfind('/')+1]
+            if folder!=self.folder:
+                self.folder = folder
+                self.files = self.db.get_analysed_files(folder)
+                self.states = self.db.get_file_states(folder)
+
+
+    def contains(self, path):
+        self.load_folder(path)
+        return path in self.files
+
+
+    def state_unknown(self, state):
+        # True if no state has been stored for analysis of file
+        self.load_folder(state[0])
+        stored = self.states.get(state[0])
+        return stored is None or stored[0] is None
+
+
+    def state_changed(self, state, meta_only):
+        # For analysis, files without a stored state (i.e. analysed before file
+        # states were stored) are treated as unchanged.
+        self.load_folder(state[0])
+        stored = self.states.get(state[0])
+        stored = None if stored is None else (stored[3:] if meta_only else stored[:3])
+        if stored is None or stored[0] is None:
+            return meta_only
+        return stored[0]!=state[1] or stored[1]!=state[2] or (self.check_inode and stored[2]!=state[3])
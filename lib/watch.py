@@ -0,0 +1,315 @@
+#
+# Analyse files with Essentia
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+# Watch music folder (using inotify) and analyse, move, or remove tracks as
+# files change - rather than re-reading the whole folder.
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import tempfile
+import time
+from . import analysis, cue, dedup, tracks_db
+
+_LOGGER = logging.getLogger(__name__)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+# How often to check for stop file, in seconds
+STOP_CHECK_INTERVAL = 5
+# Changes are applied once none have occurred for 'watch_delay' seconds, or at
+# most this many times 'watch_delay' after the first.
+MAX_DELAY_FACTOR = 10
+
+
+class Inotify(object):
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd<0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # Watch descriptor to folder path (ending with '/')
+        self.watches = {}
+
+
+    def add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd<0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.watches[wd] = path
+
+
+    def add_tree(self, path):
+        # path must end with '/'
+        self.add(path)
+        try:
+            entries = list(os.scandir(path))
+        except OSError as e:
+            _LOGGER.error("Failed to read '%s' - %s" % (path, str(e)))
+            return
+        for e in entries:
+            if e.is_dir():
+                try:
+                    self.add_tree(e.path+'/')
+                except OSError as err:
+                    # ENOSPC if fs.inotify.max_user_watches is too low
+                    _LOGGER.error('Failed to watch %s - %s' % (e.path, err.strerror))
+
+
+    def remove_tree(self, path):
+        for wd in [wd for wd, folder in self.watches.items() if folder.startswith(path)]:
+            self.libc.inotify_rm_watch(self.fd, wd)
+            del self.watches[wd]
+
+
+    def moved(self, old_path, new_path):
+        for wd, folder in self.watches.items():
+            if folder.startswith(old_path):
+                self.watches[wd] = new_path+folder[len(old_path):]
+
+
+    def read(self, timeout):
+        # Returns list of (wd, mask, cookie, name). wd is None on overflow. Watch
+        # descriptors are mapped to folders as each event is handled, so that
+        # folders renamed by earlier events in the same batch are followed.
+        events = []
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return events
+        data = os.read(self.fd, 65536)
+        pos = 0
+        while pos<len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = os.fsdecode(data[pos:pos+length].rstrip(b'\0'))
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask, cookie, name))
+            else:
+                events.append((wd, mask, cookie, name))
+        return events
+
+
+    def close(self):
+        os.close(self.fd)
+
+
+def is_music_file(name):
+    parts = name.rsplit('.', 1)
+    return len(parts)>1 and parts[1].lower() in analysis.AUDIO_EXTENSIONS
+
+
+class Changes(object):
+    # Changes seen since last applied. Renames and removals are kept in order,
+    # and are applied as-is to the DB. Files (or folders) to (re)analyse are
+    # applied last, so their paths are updated as they are renamed.
+    def __init__(self):
+        self.ops = []
+        self.updates = set()
+        # Cookie to op of files moved, until (or if) the other side of move is seen
+        self.moves = {}
+        self.first = None
+        self.last = None
+        self.overflow = False
+
+
+    def due(self, delay):
+        return min(self.last+delay, self.first+delay*MAX_DELAY_FACTOR)
+
+
+    def changed(self):
+        self.last = time.monotonic()
+        if self.first is None:
+            self.first = self.last
+
+
+    def rename_updates(self, old_path, new_path):
+        for path in [path for path in self.updates if path==old_path or (old_path.endswith('/') and path.startswith(old_path))]:
+            self.updates.remove(path)
+            self.updates.add(new_path+path[len(old_path):])
+
+
+    def add(self, notifier, wd, mask, cookie, name):
+        if wd is None:
+            self.overflow = True
+            return
+        if mask & IN_IGNORED:
+            # Folder was removed
+            notifier.watches.pop(wd, None)
+            return
+        folder = notifier.watches.get(wd)
+        if folder is None:
+            return
+        is_dir = (mask & IN_ISDIR)!=0
+        path = folder + name + ('/' if is_dir else '')
+        if not is_dir and name.endswith('.cue'):
+            # Any change to a CUE file causes its music file to be re-checked
+            self.updates.add(path)
+        elif mask & IN_MOVED_TO:
+            op = self.moves.pop(cookie, None)
+            if op is not None and (is_dir or is_music_file(name)):
+                op[0] = 'rename'
+                op[2] = path
+                self.rename_updates(op[1], path)
+                if is_dir:
+                    notifier.moved(op[1], path)
+            elif is_dir:
+                # Moved into music folder
+                self.add_folder(notifier, path)
+            elif is_music_file(name):
+                self.updates.add(path)
+            else:
+                return
+        elif not is_dir and not is_music_file(name):
+            return
+        elif mask & IN_MOVED_FROM:
+            # Treated as a removal, unless the other side of the move is seen
+            op = ['remove', path, None, is_dir]
+            self.ops.append(op)
+            self.moves[cookie] = op
+        elif mask & IN_DELETE:
+            self.ops.append(['remove', path, None, is_dir])
+            for update in [update for update in self.updates if update==path or (is_dir and update.startswith(path))]:
+                self.updates.remove(update)
+        elif mask & IN_CREATE:
+            if not is_dir:
+                # Wait for file to be closed
+                return
+            self.add_folder(notifier, path)
+        elif mask & IN_CLOSE_WRITE:
+            self.updates.add(path)
+        self.changed()
+
+
+    def add_folder(self, notifier, path):
+        # Files may have been added before watch was, so analyse whole folder
+        try:
+            notifier.add_tree(path)
+        except OSError as e:
+            _LOGGER.error('Failed to watch %s - %s' % (path, str(e)))
+        self.updates.add(path)
+
+
+def get_file_tracks(db, analysed, lms_meta, config, path, tmp_path, meta_only):
+    root_len = len(config['essentia'])
+    try:
+        st = os.stat(path)
+    except OSError:
+        # Removed, or renamed, since change was seen
+        return []
+    db_path = path[root_len:]
+    has_cue = os.path.exists(path.rsplit('.', 1)[0]+'.cue')
+    # Remove tracks no longer listed in CUE file, or CUE tracks if it has been
+    # removed. If LMS does not (yet) have the CUE tracks, existing ones are kept.
+    existing = db.get_source_tracks(db_path)
+    if has_cue:
+        tracks = set(track['file'][len(tmp_path)+1:] for track in cue.get_cue_tracks(lms_meta, config['lms'], path, root_len, tmp_path+'/'))
+        stale = existing - tracks if len(tracks)>0 else set()
+    else:
+        stale = existing - set([db_path])
+    if len(stale)>0:
+        _LOGGER.debug('Removing %d old tracks of %s' % (len(stale), db_path))
+        db.remove_tracks(stale)
+    return list(analysis.get_file_tracks(analysed, lms_meta, config['lms'], path, st, has_cue, root_len, tmp_path+'/', len(tmp_path)+1, meta_only))
+
+
+def apply_changes(config, notifier, changes, meta_only):
+    root_len = len(config['essentia'])
+    db = tracks_db.TracksDb(config)
+    renamed = 0
+    removed = 0
+    for op, path, new_path, is_dir in changes.ops:
+        if 'rename'==op:
+            _LOGGER.debug('Renamed %s to %s' % (path[root_len:], new_path[root_len:]))
+            renamed += db.rename_files(path[root_len:], new_path[root_len:], is_dir)
+        else:
+            if is_dir:
+                notifier.remove_tree(path)
+            _LOGGER.debug('Removed %s' % path[root_len:])
+            removed += db.remove_files(path[root_len:], is_dir)
+
+    # CUE files are replaced by the music files they refer to
+    paths = set()
+    for path in changes.updates:
+        if path.endswith('.cue'):
+            paths.update(['%s.%s' % (path[:-4], ext) for ext in analysis.AUDIO_EXTENSIONS])
+        else:
+            paths.add(path)
+
+    files = {}
+    lms_meta = cue.LmsCueMetadata(config['lmsdb']) if 'lmsdb' in config else None
+    with tempfile.TemporaryDirectory(dir=config['tmp'] if 'tmp' in config else None) as tmp_path:
+        analysed = tracks_db.AnalysedFiles(db, True, config['check_inode'])
+        for path in sorted(paths):
+            if path.endswith('/'):
+                found = analysis.get_files_to_analyse(analysed, lms_meta, config['lms'], path, root_len, tmp_path+'/', len(tmp_path)+1, meta_only)
+            else:
+                found = get_file_tracks(db, analysed, lms_meta, config, path, tmp_path, meta_only)
+            for f in found:
+                files[f['db']] = f
+        _LOGGER.info('Renamed %d, removed %d, and updating %d tracks' % (renamed, removed, len(files)))
+        if meta_only:
+            analysis.update_db(db, list(files.values()), config)
+        elif len(files)>0:
+            allfiles = list(files.values())
+            if config['dedup']:
+                allfiles = list(dedup.filter_files(db, allfiles, config))
+            if config['longest_first']:
+                allfiles = analysis.longest_first(allfiles, config)
+            analysis.analyse_tracks(db, allfiles, tmp_path, config, len(files))
+    db.commit()
+    db.close()
+    if renamed>0 or removed>0 or len(files)>0:
+        analysis.export_features(config)
+
+
+def watch_files(config, remove_tracks, meta_only):
+    # Watches are added before the initial analysis, so that changes made
+    # whilst that runs are queued.
+    root = config['essentia']
+    try:
+        notifier = Inotify()
+        notifier.add_tree(root)
+    except OSError as e:
+        _LOGGER.error('Failed to watch %s - %s' % (root, str(e)))
+        return
+    _LOGGER.info('Watching %d folders' % len(notifier.watches))
+    analysis.analyse_files(config, remove_tracks, meta_only)
+
+    changes = Changes()
+    try:
+        while not analysis.stop_requested(config):
+            timeout = STOP_CHECK_INTERVAL if changes.first is None else max(0, min(STOP_CHECK_INTERVAL, changes.due(config['watch_delay'])-time.monotonic()))
+            for event in notifier.read(timeout):
+                changes.add(notifier, *event)
+            if changes.overflow:
+                _LOGGER.warning('Too many changes, re-reading music folder')
+                notifier.add_tree(root)
+                analysis.analyse_files(config, remove_tracks, meta_only)
+                changes = Changes()
+            elif changes.first is not None and time.monotonic()>=changes.due(config['watch_delay']):
+                apply_changes(config, notifier, changes, meta_only)
+                changes = Changes()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        notifier.close()
+    _LOGGER.debug('Finished watching')
@@ -11,7 +11,7 @@ import argparse
 import os
 import sqlite3
 import sys
-from lib import version
+from lib import features, ignore_rules, tracks_db, version
 
 
 def info(s):
@@ -28,26 +28,46 @@ def ignore(conn, cursor, f):
         error('%s does not exist' % f)
 
     try:
-        lines=[]
         with open(f, 'r') as ifile:
-            lines = ifile.readlines();
-        cursor.execute('UPDATE tracks set ignore=0')
-        for line in lines:
-            val = line.strip()
-            info('Ignore: %s' % val)
-            cursor.execute('UPDATE tracks set ignore=1 where file like ?', ('{}%'.format(val),))
+            rules = ignore_rules.IgnoreRules(ifile.readlines())
+        info('Ignore: %d prefixes, %d globs, %d genres' % (len(rules.prefixes), len(rules.globs), len(rules.genres)))
         conn.commit()
+        ignored, changed, duration = ignore_rules.update_ignore(cursor, rules)
+        info('Ignoring %d tracks, updated %d in %.2f seconds' % (ignored, changed, duration))
     except Exception as e:
         error('Failed to parse %s - %s' % (f, str(e)))
 
 
+def compact(conn, cursor):
+    try:
+        conn.commit()
+        if tracks_db.is_compact(cursor):
+            info('DB is already compact')
+        else:
+            tracks_db.make_compact(cursor)
+            info('Converted DB to compact format')
+    except Exception as e:
+        error('Failed to convert DB - %s' % str(e))
+
+
+def export_features(db, path, partitions):
+    try:
+        if features.export_features(db, path, partitions):
+            info('Exported features to %s.npy' % path)
+    except ImportError:
+        error('numpy is required to export features')
+
+
 if __name__=='__main__':
     parser = argparse.ArgumentParser(description='Update Essentia DB (v%s)' % version.ESSENTIA_ANALYZER_VERSION)
     parser.add_argument('-d', '--db', type=str, help='Database file', default='essentia.db')
     parser.add_argument('-i', '--ignore', type=str, help='Path to file containing items to ignore', default=None)
+    parser.add_argument('-c', '--compact', action='store_true', default=False, help='Convert DB to compact format')
+    parser.add_argument('-f', '--features', type=str, help='Export feature matrix, to this path (without extension)', default=None)
+    parser.add_argument('-p', '--partitions', type=int, help='Number of partitions to create in feature index (default: %(default)s)', default=0)
     args = parser.parse_args()
 
-    if args.ignore is None:
+    if args.ignore is None and args.features is None and not args.compact:
         info("Nothing todo")
     else:
         try:
@@ -56,6 +76,12 @@ if __name__=='__main__':
         except:
             error("Failed to open DB")
 
+        if args.compact:
+            compact(conn, cursor)
+
         if args.ignore is not None:
             ignore(conn, cursor, args.ignore)
 
+        if args.features is not None:
+            export_features(args.db, args.features, args.partitions)
+